@@ -1,27 +1,19 @@
-import random
-import pygame
-from agent import TetrisAgent
-
 """
-10 x 20 grid
-play_height = 2 * play_width
-
-tetriminos:
-    0 - S - green
-    1 - Z - red
-    2 - I - cyan
-    3 - O - yellow
-    4 - J - blue
-    5 - L - orange
-    6 - T - purple
+Playable Tetris window and the main game loop. The rules live in rules.py;
+pygame is only imported by the code that draws or reads input, so training
+games run without loading it.
 """
-
-pygame.font.init()
+import random
+import time
+from agent import TetrisAgent
+from board import Board
+from rules import col, row, S, Z, I, O, J, L, T, shapes, shape_colors, Orientation, shape_table, Piece, \
+    PieceBag, create_grid, convert_shape_format, valid_space, lock_piece, check_lost, clear_rows, \
+    line_clear_score, get_game_state
+from stats import open_store
 
 # global variables
 
-col = 10  # 10 columns
-row = 20  # 20 rows
 s_width = 800  # window width
 s_height = 750  # window height
 play_width = 300  # play window width; 300/10 = 30 width per block
@@ -31,329 +23,179 @@ block_size = 30  # size of block
 top_left_x = (s_width - play_width) // 2
 top_left_y = s_height - play_height - 50
 
-filepath = './highscore.txt'
+filepath = './highscore.txt'  # highscore of versions before stats.db, imported into a new store
+statspath = './stats.db'
 fontpath = './arcade.ttf'
 fontpath_mario = './mario.ttf'
 
-# shapes formats
-
-S = [['.....',
-      '.....',
-      '..00.',
-      '.00..',
-      '.....'],
-     ['.....',
-      '..0..',
-      '..00.',
-      '...0.',
-      '.....']]
-
-Z = [['.....',
-      '.....',
-      '.00..',
-      '..00.',
-      '.....'],
-     ['.....',
-      '..0..',
-      '.00..',
-      '.0...',
-      '.....']]
-
-I = [['.....',
-      '..0..',
-      '..0..',
-      '..0..',
-      '..0..'],
-     ['.....',
-      '0000.',
-      '.....',
-      '.....',
-      '.....']]
-
-O = [['.....',
-      '.....',
-      '.00..',
-      '.00..',
-      '.....']]
-
-J = [['.....',
-      '.0...',
-      '.000.',
-      '.....',
-      '.....'],
-     ['.....',
-      '..00.',
-      '..0..',
-      '..0..',
-      '.....'],
-     ['.....',
-      '.....',
-      '.000.',
-      '...0.',
-      '.....'],
-     ['.....',
-      '..0..',
-      '..0..',
-      '.00..',
-      '.....']]
-
-L = [['.....',
-      '...0.',
-      '.000.',
-      '.....',
-      '.....'],
-     ['.....',
-      '..0..',
-      '..0..',
-      '..00.',
-      '.....'],
-     ['.....',
-      '.....',
-      '.000.',
-      '.0...',
-      '.....'],
-     ['.....',
-      '.00..',
-      '..0..',
-      '..0..',
-      '.....']]
-
-T = [['.....',
-      '..0..',
-      '.000.',
-      '.....',
-      '.....'],
-     ['.....',
-      '..0..',
-      '..00.',
-      '..0..',
-      '.....'],
-     ['.....',
-      '.....',
-      '.000.',
-      '..0..',
-      '.....'],
-     ['.....',
-      '..0..',
-      '.00..',
-      '..0..',
-      '.....']]
-
-# index represents the shape
-shapes = [S, Z, I, O, J, L, T]
-shape_colors = [(0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 255, 0), (255, 165, 0), (0, 0, 255), (128, 0, 128)]
-
-
-# class to represent each of the pieces
-class Piece(object):
-    def __init__(self, x, y, shape):
-        self.x = x
-        self.y = y
-        self.shape = shape
-        self.color = shape_colors[shapes.index(shape)]
-        self.rotation = 0
-
-
-class PieceBag:
-    def __init__(self):
-        self.pieces = []
-
-    def get_shape(self):
-        if not self.pieces:
-            bag = list(shapes)
-            random.shuffle(bag)
-            pieces = []
-            for shape in bag:
-                pieces.append(Piece(5, 0, shape))
-            self.pieces = pieces
-        return self.pieces.pop()
-
-
-def create_grid(locked_pos={}):
-    grid = [[(0, 0, 0) for x in range(col)] for y in range(row)]
-    
-    for y in range(row):
-        for x in range(col):
-            if (x, y) in locked_pos:
-                color = locked_pos[(x, y)]
-                grid[y][x] = color
-
-    return grid
-
+fonts = {}
+static_labels = {}
+stats_stores = {}
 
-def convert_shape_format(piece):
-    positions = []
-    shape_format = piece.shape[piece.rotation % len(piece.shape)]
 
-    for i, line in enumerate(shape_format):
-        row_list = list(line)
-        for j, column in enumerate(row_list):
-            if column == '0':
-                positions.append((piece.x + j, piece.y + i))
+def get_font(path, size):
+    """Loads every font once and keeps it for the rest of the program."""
+    import pygame
+    key = (path, size)
+    if key not in fonts:
+        fonts[key] = pygame.font.Font(path, size)
+    return fonts[key]
 
-    for i, pos in enumerate(positions):
-        positions[i] = (pos[0] - 2, pos[1] - 4)
 
-    return positions
-
-
-def valid_space(piece, grid):
-    accepted_pos = [[(x, y) for x in range(col) if grid[y][x] == (0, 0, 0)] for y in range(row)]
-    accepted_pos = [x for item in accepted_pos for x in item]
-
-    formatted_shape = convert_shape_format(piece)
-
-    for pos in formatted_shape:
-        if pos not in accepted_pos:
-            if pos[1] >= 0:
-                return False
-    return True
-
-
-def check_lost(positions):
-    for pos in positions:
-        x, y = pos
-        if y < 1:
-            return True
-    return False
+def render_static(text, size, color=(255, 255, 255), path=fontpath):
+    """Rendered text that never changes, like titles and button labels, rendered only once."""
+    key = (text, size, color, path)
+    if key not in static_labels:
+        static_labels[key] = get_font(path, size).render(text, 1, color)
+    return static_labels[key]
 
 
 def draw_text_middle(text, size, color, surface):
-    font = pygame.font.Font(fontpath, size)
-    label = font.render(text, 1, color)
+    label = get_font(fontpath, size).render(text, 1, color)
 
     surface.blit(label, (top_left_x + play_width/2 - (label.get_width()/2), top_left_y + play_height/2 - (label.get_height()/2)))
 
 
-def draw_grid(surface):
-    grid_color = (0, 0, 0)
-    for i in range(row):
-        pygame.draw.line(surface, grid_color, (top_left_x, top_left_y + i * block_size),
-                         (top_left_x + play_width, top_left_y + i * block_size))
-    for j in range(col):
-        pygame.draw.line(surface, grid_color, (top_left_x + j * block_size, top_left_y),
-                             (top_left_x + j * block_size, top_left_y + play_height))
-
-
-def clear_rows(grid, locked):
+class Renderer:
     """
-    Checks for completed rows, clears them, and shifts the rows above down.
-    Returns the number of rows cleared.
+    Draws the game screen onto a surface, repainting only what changed since
+    the last frame: the cells whose color changed, the labels whose value
+    changed and the next piece when a new one comes up. Only those areas are
+    pushed to the display.
     """
-    rows_to_clear = []
-    for i in range(len(grid)):
-        if (0, 0, 0) not in grid[i]:
-            rows_to_clear.append(i)
-
-    cleared_count = len(rows_to_clear)
-
-    if cleared_count > 0:
-        new_locked = {}
-        for (x, y), color in locked.items():
-            if y not in rows_to_clear:
-                shift = sum(1 for cleared_row_index in rows_to_clear if y < cleared_row_index)
-                new_locked[(x, y + shift)] = color
-        
-        locked.clear()
-        locked.update(new_locked)
-
-    return cleared_count
-
-
-def draw_next_shape(piece, surface):
-    font = pygame.font.Font(fontpath, 30)
-    label = font.render('Next shape', 1, (255, 255, 255))
-
-    start_x = top_left_x + play_width + 50
-    start_y = top_left_y + (play_height / 2 - 100)
-
-    shape_format = piece.shape[piece.rotation % len(piece.shape)]
-
-    for i, line in enumerate(shape_format):
-        row_list = list(line)
-        for j, column in enumerate(row_list):
-            if column == '0':
-                pygame.draw.rect(surface, piece.color, (start_x + j*block_size, start_y + i*block_size, block_size, block_size), 0)
-
-    surface.blit(label, (start_x, start_y - 30))
-
-
-def draw_window(surface, grid, score=0, last_score=0, level=1):
-    surface.fill((0, 0, 0))
-
-    pygame.font.init()
-    font = pygame.font.Font(fontpath_mario, 65)
-    label = font.render('TETRIS', 1, (255, 255, 255))
-
-    surface.blit(label, ((top_left_x + play_width / 2) - (label.get_width() / 2), 30))
-
-    # current score
-    font = pygame.font.Font(fontpath, 25)
-    label = font.render('SCORE   ' + str(score) , 1, (255, 255, 255))
-
-    start_x = top_left_x + play_width + 50
-    start_y = top_left_y + (play_height / 2 - 100)
-
-    surface.blit(label, (start_x, start_y + 200))
-
-    # last score
-    label_hi = font.render('HIGHSCORE   ' + str(last_score), 1, (255, 255, 255))
-
-    start_x_hi = top_left_x - 240
-    start_y_hi = top_left_y + 200
-
-    surface.blit(label_hi, (start_x_hi + 20, start_y_hi + 200))
-
-    # Level
-    label_level = font.render('LEVEL: ' + str(level), 1, (255, 255, 255))
-    surface.blit(label_level, (start_x_hi + 20, start_y_hi + 240))
-
-    # draw content of the grid
-    for i in range(row):
-        for j in range(col):
-            pygame.draw.rect(surface, grid[i][j],
-                             (top_left_x + j * block_size, top_left_y + i * block_size, block_size, block_size), 0)
-
-    draw_grid(surface)
-
-    # draw rectangular border around play area
-    border_color = (255, 255, 255)
-    pygame.draw.rect(surface, border_color, (top_left_x, top_left_y, play_width, play_height), 4)
-
-
-def update_score(new_score):
-    score = get_max_score()
-
-    with open(filepath, 'w') as file:
-        if new_score > score:
-            file.write(str(new_score))
+    def __init__(self, surface):
+        self.surface = surface
+        self.cells = None  # colors of the play area as they were last drawn
+        self.labels = {}  # (text, rect) of every label as it was last drawn
+        self.next_piece = None  # (color, orientation) of the next piece as it was last drawn
+        self.next_rects = []
+        self.dirty = []  # areas of the surface changed since the last display update
+
+    def draw(self, grid, score=0, last_score=0, level=1, next_piece=None):
+        """Draws a frame and pushes the parts that changed to the display."""
+        import pygame
+        if self.cells is None:
+            self.draw_all(grid, score, last_score, level, next_piece)
+            pygame.display.update()
         else:
-            file.write(str(score))
-
-
-def get_max_score():
-    try:
-        with open(filepath, 'r') as file:
-            lines = file.readlines()
-            if lines:
-                score = int(lines[0].strip())
-            else:
-                score = 0
-    except (FileNotFoundError, IndexError, ValueError):
-        score = 0
-    return score
-
-
-def get_game_state(current_piece, next_piece, grid, locked_positions):
-    return {
-        'current_piece': current_piece,
-        'next_piece': next_piece,
-        'grid': grid,
-        'locked_positions': locked_positions
-    }
-
-
-def main(window=None, agent=None, is_training=False):
+            self.draw_labels(score, last_score, level)
+            self.draw_next(next_piece)
+            self.draw_cells(grid)
+            if self.dirty:
+                pygame.display.update(self.dirty)
+        self.dirty = []
+
+    def draw_all(self, grid, score=0, last_score=0, level=1, next_piece=None):
+        """Repaints the whole screen."""
+        surface = self.surface
+        surface.fill((0, 0, 0))
+
+        label = render_static('TETRIS', 65, path=fontpath_mario)
+        surface.blit(label, ((top_left_x + play_width / 2) - (label.get_width() / 2), 30))
+
+        self.labels = {}
+        self.draw_labels(score, last_score, level)
+        self.draw_cells(grid, everything=True)
+        if next_piece is not None:
+            surface.blit(render_static('Next shape', 30),
+                         (top_left_x + play_width + 50, top_left_y + (play_height / 2 - 100) - 30))
+            self.next_piece = None
+            self.next_rects = []
+            self.draw_next(next_piece)
+        self.dirty = [surface.get_rect()]
+
+    def draw_labels(self, score, last_score, level):
+        import pygame
+        start_x = top_left_x + play_width + 50
+        start_y = top_left_y + (play_height / 2 - 100)
+        start_x_hi = top_left_x - 240
+        start_y_hi = top_left_y + 200
+
+        labels = [
+            ('score', 'SCORE   ' + str(score), (start_x, start_y + 200)),
+            ('highscore', 'HIGHSCORE   ' + str(last_score), (start_x_hi + 20, start_y_hi + 200)),
+            ('level', 'LEVEL: ' + str(level), (start_x_hi + 20, start_y_hi + 240)),
+        ]
+        play_area = pygame.Rect(top_left_x, top_left_y, play_width, play_height)
+        for name, text, position in labels:
+            old = self.labels.get(name)
+            if old is not None and old[0] == text:
+                continue
+            label = get_font(fontpath, 25).render(text, 1, (255, 255, 255))
+            rect = label.get_rect(topleft=position)
+            if old is not None:
+                self.surface.fill((0, 0, 0), old[1])
+                self.dirty.append(old[1])
+            self.surface.blit(label, position)
+            self.dirty.append(rect)
+            self.labels[name] = (text, rect)
+            # the play area is drawn over long labels, so it has to be drawn again
+            if self.cells is not None and (rect.colliderect(play_area) or
+                                           old is not None and old[1].colliderect(play_area)):
+                self.cells = [[None] * col for _ in range(row)]
+
+    def draw_cells(self, grid, everything=False):
+        import pygame
+        surface = self.surface
+        changed = []
+        for i in range(row):
+            line = grid[i]
+            old = self.cells[i] if not everything else None
+            for j in range(col):
+                color = line[j]
+                if old is not None and old[j] == color:
+                    continue
+                x = top_left_x + j * block_size
+                y = top_left_y + i * block_size
+                pygame.draw.rect(surface, color, (x, y, block_size, block_size), 0)
+                # grid lines along the top and left edge of the cell
+                pygame.draw.line(surface, (0, 0, 0), (x, y), (x + block_size, y))
+                pygame.draw.line(surface, (0, 0, 0), (x, y), (x, y + block_size))
+                changed.append(pygame.Rect(x, y, block_size, block_size))
+
+        if changed:
+            # draw rectangular border around play area
+            border_color = (255, 255, 255)
+            pygame.draw.rect(surface, border_color, (top_left_x, top_left_y, play_width, play_height), 4)
+            self.dirty.extend(changed)
+        self.cells = [line[:] for line in grid]
+
+    def draw_next(self, piece):
+        import pygame
+        if piece is None or self.next_piece == (piece.color, piece.orientation):
+            return
+        for rect in self.next_rects:
+            self.surface.fill((0, 0, 0), rect)
+        self.dirty.extend(self.next_rects)
+
+        start_x = top_left_x + play_width + 50
+        start_y = top_left_y + (play_height / 2 - 100)
+        self.next_rects = []
+        for x, y in piece.orientation.cells:
+            rect = pygame.Rect(start_x + (x + 2)*block_size, start_y + (y + 4)*block_size, block_size, block_size)
+            pygame.draw.rect(self.surface, piece.color, rect, 0)
+            self.next_rects.append(rect)
+        self.dirty.extend(self.next_rects)
+        self.next_piece = (piece.color, piece.orientation)
+
+
+def get_stats_store(path=statspath):
+    """The StatsStore at path, opened once per process."""
+    if path not in stats_stores:
+        stats_stores[path] = open_store(path, filepath)
+    return stats_stores[path]
+
+
+def save_game(stats, mode, agent, seed, score, lines, level, pieces, started):
+    """Adds a finished game to the stats store. Games played on screen are written right away."""
+    stats.add_game(mode, score, agent.weights if agent is not None else None, seed, lines, level, pieces,
+                   time.perf_counter() - started)
+    if mode != 'training':
+        stats.flush()
+
+
+def main(window=None, agent=None, is_training=False, direct_placement=False, seed=None, rng=None, timer=None,
+         recorder=None, max_pieces=None, time_limit=None, stats=None):
     """
     Main game loop. Can be run in normal, AI, or training mode.
     
@@ -361,7 +203,33 @@ def main(window=None, agent=None, is_training=False):
         window: The pygame screen surface to draw on.
         agent: The AI agent that will play the game.
         is_training: Flag to run in high-speed mode without visuals.
+        direct_placement: Flag to apply each AI placement in a single loop pass
+            instead of moving the piece one step per frame. Scores are the same.
+        seed: Seed of the piece sequence. The same seed always deals the same pieces.
+        rng: Random number generator to draw the pieces from, instead of a seed.
+            Without either, pieces come from the global random module.
+        timer: PhaseTimer that times every phase of the loop and the agent's decisions.
+        recorder: ReplayRecorder that records the seed and every placement of the game.
+        max_pieces: Ends the game after this many pieces have been placed.
+        time_limit: Ends the game once a piece is placed after this many seconds.
+        stats: StatsStore the finished game is added to. Games that aren't training games
+            go to the store at statspath by default, training games only to a given store.
+
+    Returns the score, or (score, timings) with the timer's report when a timer is given.
     """
+    if timer is None:
+        return game_loop(window, agent, is_training, direct_placement, seed, rng, None, recorder, max_pieces, time_limit,
+                         stats)
+
+    with timer.profiling():
+        score = game_loop(window, agent, is_training, direct_placement, seed, rng, timer, recorder, max_pieces,
+                          time_limit, stats)
+    return score, timer.report()
+
+
+def game_loop(window, agent, is_training, direct_placement, seed, rng, timer=None, recorder=None, max_pieces=None,
+              time_limit=None, stats=None):
+    """Plays one game and returns the score, see main for the arguments."""
     is_ai_controlled = False
     if agent:
         is_ai_controlled = True
@@ -372,35 +240,51 @@ def main(window=None, agent=None, is_training=False):
         except NameError:
             is_ai_controlled = False
 
-    locked_positions = {}
+    board = Board(col, row)
     
     change_piece = False
     run = True
 
-    pieces = PieceBag()
+    if rng is None and seed is not None:
+        rng = random.Random(seed)
+    pieces = PieceBag(rng)
+    if recorder is not None:
+        recorder.start(seed)
     current_piece = pieces.get_shape()
     next_piece = pieces.get_shape()
     
     if not is_training:
+        import pygame
         clock = pygame.time.Clock()
+    renderer = Renderer(window) if window and not is_training else None
     
     fall_time = 0
+    pieces_placed = 0
+    started = time.perf_counter()
+    deadline = started + time_limit if time_limit is not None else None
     level = 1
     score = 0
     total_lines_cleared = 0
     fall_speed = 0.35
     
     if not is_training:
-        last_score = get_max_score()
+        if stats is None:
+            stats = get_stats_store()
+        # the highscore is read once, during the game it is only kept on screen
+        last_score = stats.highscore()
     else:
         last_score = 0
 
     if is_ai_controlled and agent is None:
         agent = TetrisAgent()
+    mode = 'training' if is_training else 'ai' if is_ai_controlled else 'human'
+    if timer is not None and agent is not None and agent.timer is None:
+        agent.timer = timer
 
     while run:
-        grid = create_grid(locked_positions)
-        
+        if timer is not None:
+            timer.count('frames')
+
         if not is_training:
             fall_time += clock.get_rawtime()
             clock.tick(60)
@@ -410,7 +294,7 @@ def main(window=None, agent=None, is_training=False):
             if fall_time / 1000 > fall_speed:
                 fall_time = 0
                 current_piece.y += 1
-                if not valid_space(current_piece, grid) and current_piece.y > 0:
+                if not valid_space(current_piece, board) and current_piece.y > 0:
                     current_piece.y -= 1
                     change_piece = True
         
@@ -420,28 +304,28 @@ def main(window=None, agent=None, is_training=False):
                 if event.type == pygame.QUIT:
                     run = False
                     if not is_training:
-                        update_score(score)
+                        save_game(stats, mode, agent, seed, score, total_lines_cleared, level, pieces_placed, started)
                         pygame.display.quit()
                     return score
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_LEFT:
                         current_piece.x -= 1
-                        if not valid_space(current_piece, grid): 
+                        if not valid_space(current_piece, board): 
                             current_piece.x += 1
                     elif event.key == pygame.K_RIGHT:
                         current_piece.x += 1
-                        if not valid_space(current_piece, grid): 
+                        if not valid_space(current_piece, board): 
                             current_piece.x -= 1
                     elif event.key == pygame.K_DOWN:
                         current_piece.y += 1
-                        if not valid_space(current_piece, grid): 
+                        if not valid_space(current_piece, board): 
                             current_piece.y -= 1
                     elif event.key == pygame.K_UP:
                         current_piece.rotation = (current_piece.rotation + 1) % len(current_piece.shape)
-                        if not valid_space(current_piece, grid): 
+                        if not valid_space(current_piece, board): 
                             current_piece.rotation = (current_piece.rotation - 1) % len(current_piece.shape)
                     elif event.key == pygame.K_SPACE:
-                        while valid_space(current_piece, grid):
+                        while valid_space(current_piece, board):
                             current_piece.y += 1
                         current_piece.y -= 1
                         change_piece = True
@@ -453,63 +337,96 @@ def main(window=None, agent=None, is_training=False):
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
                         run = False
+                        save_game(stats, mode, agent, seed, score, total_lines_cleared, level, pieces_placed, started)
                         return score
             
             if not hasattr(current_piece, 'ai_plan'):
-                game_state = get_game_state(current_piece, next_piece, grid, locked_positions)
+                if timer is not None:
+                    start = timer.start()
+                game_state = get_game_state(current_piece, next_piece, board)
                 ai_target_action = agent.choose_action(game_state)
                 current_piece.ai_plan = {
                     'target_x': ai_target_action['x'],
                     'target_rotation': ai_target_action['rotation'],
-                    'target_y': ai_target_action['y']
+                    'target_y': ai_target_action['y'],
+                    # inputs that reach the target, only for agents that search the reachable placements
+                    'path': list(ai_target_action.get('path', []))
                 }
+                if timer is not None:
+                    timer.add('decision', start)
             
+            if timer is not None:
+                start = timer.start()
             plan = current_piece.ai_plan
 
+            # Jump straight to the target and hard drop
+            if direct_placement:
+                current_piece.x = plan['target_x']
+                current_piece.rotation = plan['target_rotation']
+                current_piece.y = max(current_piece.y, plan['target_y'])
+                while valid_space(current_piece, board):
+                    current_piece.y += 1
+                current_piece.y -= 1
+                change_piece = True
+                del current_piece.ai_plan
+            # Follow the input path, one input per frame, then fall through to the hard drop
+            elif plan['path']:
+                move = plan['path'].pop(0)
+                position = (current_piece.x, current_piece.y, current_piece.rotation)
+                if move == 'left':
+                    current_piece.x -= 1
+                elif move == 'right':
+                    current_piece.x += 1
+                elif move == 'rotate':
+                    current_piece.rotation = (current_piece.rotation + 1) % len(current_piece.shape)
+                elif move == 'down':
+                    current_piece.y += 1
+                if not valid_space(current_piece, board):
+                    current_piece.x, current_piece.y, current_piece.rotation = position
             # Move horizontally first
-            if current_piece.x < plan['target_x']:
+            elif current_piece.x < plan['target_x']:
                 current_piece.x += 1
-                if not valid_space(current_piece, grid):
+                if not valid_space(current_piece, board):
                     current_piece.x -= 1
             elif current_piece.x > plan['target_x']:
                 current_piece.x -= 1
-                if not valid_space(current_piece, grid):
+                if not valid_space(current_piece, board):
                     current_piece.x += 1
             # Then rotate
             elif current_piece.rotation != plan['target_rotation']:
                 current_piece.rotation = (current_piece.rotation + 1) % len(current_piece.shape)
-                if not valid_space(current_piece, grid):
+                if not valid_space(current_piece, board):
                     current_piece.rotation = (current_piece.rotation - 1) % len(current_piece.shape)
             # Then soft drop
             elif current_piece.y < plan['target_y']:
                 current_piece.y += 1
-                if not valid_space(current_piece, grid):
+                if not valid_space(current_piece, board):
                     current_piece.y -= 1
             # If at target, hard drop and lock
             else:
-                while valid_space(current_piece, grid):
+                while valid_space(current_piece, board):
                     current_piece.y += 1
                 current_piece.y -= 1
                 change_piece = True
                 if hasattr(current_piece, 'ai_plan'):
                     del current_piece.ai_plan
+            if timer is not None:
+                timer.add('movement', start)
         
         # Piece Locking and Game State Update
         if change_piece:
-            piece_pos = convert_shape_format(current_piece)
-            for pos in piece_pos:
-                if 0 <= pos[0] < col and 0 <= pos[1] < row:
-                    locked_positions[(pos[0], pos[1])] = current_piece.color
-            
-            # Rebuild grid with locked piece before checking for line clears
-            grid = create_grid(locked_positions)
-            lines_cleared_this_turn = clear_rows(grid, locked_positions)
+            if timer is not None:
+                start = timer.start()
+            lock_piece(current_piece, board)
+            if recorder is not None:
+                recorder.record(current_piece)
+            lines_cleared_this_turn = clear_rows(board)
             
             if lines_cleared_this_turn > 0:
                 total_lines_cleared += lines_cleared_this_turn
-                score_multipliers = {1: 40, 2: 100, 3: 300, 4: 1200}
-                base_points = score_multipliers.get(lines_cleared_this_turn, 0)
-                score += base_points * level
+                if timer is not None:
+                    timer.count('lines', lines_cleared_this_turn)
+                score += line_clear_score(lines_cleared_this_turn, level)
                 
                 if total_lines_cleared >= level * 10:
                     level += 1
@@ -519,10 +436,8 @@ def main(window=None, agent=None, is_training=False):
                 # Show line clear animation if not training
                 if not is_training and window:
                     # Flash the cleared lines briefly
-                    temp_grid = create_grid(locked_positions)
-                    draw_window(window, temp_grid, score, last_score, level)
-                    draw_next_shape(next_piece, window)
-                    pygame.display.update()
+                    temp_grid = create_grid(board)
+                    renderer.draw(temp_grid, score, last_score, level, next_piece)
                     pygame.time.wait(50)
             
             current_piece = next_piece
@@ -531,12 +446,27 @@ def main(window=None, agent=None, is_training=False):
             
             if not is_training and score > last_score:
                 last_score = score
-                update_score(last_score)
+
+            if timer is not None:
+                timer.add('lock_clear', start)
+                timer.count('pieces')
+
+            # Budgets
+            pieces_placed += 1
+            if max_pieces is not None and pieces_placed >= max_pieces:
+                run = False
+            if deadline is not None and time.perf_counter() >= deadline:
+                run = False
 
         # Drawing (only if not training)
         if not is_training and window:
+            if timer is not None:
+                start = timer.start()
             # Use the current grid state (which may have been updated by line clears)
-            display_grid = create_grid(locked_positions)
+            display_grid = create_grid(board)
+            if timer is not None:
+                timer.add('grid', start)
+                start = timer.start()
             
             # Add current piece to display grid only if game is still running
             if run:
@@ -545,15 +475,19 @@ def main(window=None, agent=None, is_training=False):
                     if 0 <= y < row and 0 <= x < col:
                         display_grid[y][x] = current_piece.color
             
-            draw_window(window, display_grid, score, last_score, level)
-            draw_next_shape(next_piece, window)
-            pygame.display.update()
+            renderer.draw(display_grid, score, last_score, level, next_piece)
+            if timer is not None:
+                timer.add('render', start)
 
         # Check game over condition
-        if check_lost(locked_positions):
+        if check_lost(board):
             run = False
 
     # Game Over
+    if recorder is not None:
+        recorder.finish(score)
+    if stats is not None:
+        save_game(stats, mode, agent, seed, score, total_lines_cleared, level, pieces_placed, started)
     if not is_training and window:
         draw_text_middle('You Lost', 40, (255, 255, 255), window)
         pygame.display.update()
@@ -564,6 +498,7 @@ def main(window=None, agent=None, is_training=False):
 
 def draw_button(surface, text, x, y, width, height, color, hover_color):
     """Draw a button and return if it's being hovered over"""
+    import pygame
     mouse_pos = pygame.mouse.get_pos()
     button_rect = pygame.Rect(x, y, width, height)
     
@@ -574,8 +509,7 @@ def draw_button(surface, text, x, y, width, height, color, hover_color):
     
     pygame.draw.rect(surface, (255, 255, 255), button_rect, 2, border_radius=8)
     
-    font = pygame.font.Font(fontpath, 30)
-    label = font.render(text, 1, (255, 255, 255))
+    label = render_static(text, 30)
     text_x = x + (width - label.get_width()) // 2
     text_y = y + (height - label.get_height()) // 2
     surface.blit(label, (text_x, text_y))
@@ -584,6 +518,7 @@ def draw_button(surface, text, x, y, width, height, color, hover_color):
 
 
 def main_menu(window):
+    import pygame
     global ai_mode
     run = True
     clock = pygame.time.Clock()
@@ -623,6 +558,8 @@ def main_menu(window):
 
 
 if __name__ == '__main__':
+    import pygame
+    pygame.font.init()
     pygame.display.init()
     win = pygame.display.set_mode((s_width, s_height))
     pygame.display.set_caption('Tetris')
@@ -1,136 +1,232 @@
-import copy
+from collections import OrderedDict
 import numpy as np
+from reachability import reachable_placements
 
 class TetrisAgent:
-    def __init__(self, weights=None):
+    def __init__(self, weights=None, cache_size=0, cache=None, lookahead_depth=1, beam_width=5, timer=None,
+                 reachability=False):
         """
         Initializes the agent.
+
+        Args:
+            weights: Heuristic weights, the GA's current best when not given.
+            cache_size: Size of the agent's own transposition cache, off by default.
+            cache: Transposition cache to use instead, e.g. one shared by several agents.
+            lookahead_depth: Number of known pieces to plan for, 2 also places the next piece.
+            beam_width: Placements kept at each level of the lookahead, ranked by their one-piece score.
+            timer: PhaseTimer that times the parts of every decision.
+            reachability: Also consider slides and tucks under overhangs, every placement the piece
+                can reach with the game's moves. Moves then carry the inputs that reach them as 'path'.
         """
         if weights is not None:
             self.weights = weights
         else:
             self.weights = np.array([0.55580476, 0.83967109, 0.32826192, 0.26066793]) # current best weights according to GA
 
+        if cache is None and cache_size > 0:
+            cache = TranspositionCache(cache_size)
+        self.cache = cache
+        self.lookahead_depth = lookahead_depth
+        self.beam_width = beam_width
+        self.timer = timer
+        self.reachability = reachability
+
     def choose_action(self, game_state):
         """
         Given the current game state, return the best action.
         The action is the final state that the piece should land on.
         """
-        from Tetris import valid_space, convert_shape_format, col, row
-        current_piece = game_state['current_piece']
-        grid = game_state['grid']
+        board = game_state['board']
+        pieces = [game_state['current_piece']]
+        if self.lookahead_depth > 1 and game_state.get('next_piece') is not None:
+            pieces.append(game_state['next_piece'])
+        pieces = pieces[:self.lookahead_depth]
+
+        # The same board and pieces always get the same answer from the same weights
+        if self.cache is not None:
+            key = (board.key(), tuple(piece.index for piece in pieces), tuple(float(w) for w in self.weights),
+                   self.beam_width, self.reachability)
+            best_move = self.cache.get(key)
+            if self.timer is not None:
+                self.timer.count('agent.cache_hits' if best_move is not None else 'agent.cache_misses')
+            if best_move is None:
+                best_move = self.search(pieces, board)
+                self.cache.put(key, best_move)
+            return best_move
+
+        return self.search(pieces, board)
+
+    def search(self, pieces, board):
+        """Returns the best placement of the first piece, looking ahead over the others."""
+        timer = self.timer
+        if timer is not None:
+            start = timer.start()
+        possible_moves = self.get_possible_moves(pieces[0], board)
+        if timer is not None:
+            timer.add('agent.enumerate', start)
+
+        if not possible_moves:
+             return {'rotation': 0, 'x': 5, 'y': 0} # Default move if no valid moves found
+
+        if timer is not None:
+            start = timer.start()
+        scores = self.score_moves(possible_moves)
+        if timer is not None:
+            timer.add('agent.score', start)
+
+        if len(pieces) == 1:
+            # argmax picks the first of equally scored moves
+            return possible_moves[int(np.argmax(scores))]
+
+        if timer is not None:
+            start = timer.start()
+        best_move = possible_moves[0]
+        best_value = -float('inf')
+        for i in self.beam(scores):
+            value = self.lookahead_value(pieces, board, possible_moves[i])
+            if value > best_value:
+                best_value = value
+                best_move = possible_moves[i]
+        if timer is not None:
+            timer.add('agent.lookahead', start)
+
+        # every line of play tops out, fall back on the best placement of this piece alone
+        if best_value == -float('inf'):
+            return possible_moves[int(np.argmax(scores))]
+        return best_move
+
+    def lookahead_value(self, pieces, board, move):
+        """
+        Value of making the move with the first piece and then playing the other pieces as well as possible:
+        lines cleared along the way plus the score of the final placement. -inf if a later piece can't be placed.
+        """
+        orientation = pieces[0].orientations[move['rotation']]
+        child = board.copy(colors=False)
+        child.place(orientation.masks, move['x'] - 2, move['y'] - 4)
+        lines_cleared = child.clear_full_rows()
+        if child.rows[0]:
+            return -float('inf')
+
+        possible_moves = self.get_possible_moves(pieces[1], child)
+        if not possible_moves:
+            return -float('inf')
+
+        scores = self.score_moves(possible_moves)
+        if len(pieces) == 2:
+            best_value = scores.max()
+        else:
+            best_value = max(self.lookahead_value(pieces[1:], child, possible_moves[i]) for i in self.beam(scores))
+        return self.weights[0] * lines_cleared + best_value
+
+    def beam(self, scores):
+        """Indices of the beam_width best scores, best first, ties in move order."""
+        return np.argsort(-scores, kind='stable')[:self.beam_width]
+
+    def get_possible_moves(self, piece, board):
+        """Every placement of the piece that drops straight down, with the features of the resulting board."""
+        if self.reachability:
+            return self.get_reachable_moves(piece, board)
+
+        tops = board.column_tops()
         
         possible_moves = []
 
         # Try all rotations
-        for rotation in range(len(current_piece.shape)):
-            piece = copy.deepcopy(current_piece)
-            piece.rotation = rotation
-
-            # Try all columns
-            for x in range(col):
-                piece.x = x
-                
+        for rotation, orientation in enumerate(piece.orientations):
+
+            # Try all columns the piece fits in
+            for x in range(-orientation.min_x, board.width - orientation.max_x):
+
                 # Find where the piece would land in this column
-                piece.y = 0
-                while valid_space(piece, grid):
-                    piece.y += 1
-                piece.y -= 1
-
-                # Create a temporary grid representing the board after this move
-                temp_grid = [row[:] for row in grid]
-                piece_pos = convert_shape_format(piece)
-                
+                y = min(tops[x + dx] - 1 - dy for dx, dy in orientation.bottom)
+
                 # Check if the move is valid (not partially off-screen at the top)
-                if any(p[1] < 0 for p in piece_pos):
+                if y + orientation.min_y < 0:
                     continue
 
-                for x_pos, y_pos in piece_pos:
-                    if y_pos < row and x_pos < col:
-                        temp_grid[y_pos][x_pos] = piece.color
-                
                 move = {
                     'rotation': rotation,
                     'x': x,
-                    'y': piece.y,
-                    'resulting_grid': temp_grid,
+                    'y': y,
+                    'features': board.placement_features(orientation.columns, orientation.row_counts, x, y),
                 }
                 possible_moves.append(move)
-        
-        if not possible_moves:
-             return {'rotation': 0, 'x': 5, 'y': 0} # Default move if no valid moves found
-
-        best_move = self.evaluate_moves(possible_moves)
-        return best_move
 
-    def evaluate_moves(self, possible_moves):
-        """Heuristic evaluation of resulting grid state given every possible move."""
-        best_score = -float('inf')
-        best_move = possible_moves[0]
+        return possible_moves
 
+    def get_reachable_moves(self, piece, board):
+        """Every placement the piece can reach from where it is, with its input path and the features of the resulting board."""
+        possible_moves = reachable_placements(piece, board)
         for move in possible_moves:
-            grid = move['resulting_grid']
-            
-            lines_cleared = self.lines_cleared(grid)
-            holes = self.count_holes(grid)
-            aggregate_height = self.get_aggregate_height(grid)
-            bumpiness = self.get_bumpiness(grid)
-            
-            # Use the agent's weights for evaluation
-            score = (self.weights[0] * lines_cleared -
-                     self.weights[1] * holes -
-                     self.weights[2] * aggregate_height -
-                     self.weights[3] * bumpiness)
-
-            if score > best_score:
-                best_score = score
-                best_move = move
-        
-        return best_move
+            orientation = piece.orientations[move['rotation']]
+            move['features'] = board.placement_features(orientation.columns, orientation.row_counts,
+                                                        move['x'], move['y'])
+        return possible_moves
+
+    def score_moves(self, possible_moves):
+        """Heuristic score of the resulting board of every possible move."""
+        features = np.array([move['features'] for move in possible_moves])
+
+        # Use the agent's weights for evaluation, one column per feature so that
+        # every move is scored with exactly the same arithmetic as a single board
+        lines_cleared, holes, aggregate_height, bumpiness = features.T
+        return (self.weights[0] * lines_cleared -
+                self.weights[1] * holes -
+                self.weights[2] * aggregate_height -
+                self.weights[3] * bumpiness)
+
+
+class TranspositionCache:
+    """
+    Bounded map from (board, piece, weights) keys to the best placement and its
+    features. The least recently used entries are dropped once it is full.
+    """
+    def __init__(self, max_size=20000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        move = self.entries.get(key)
+        if move is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return move
+
+    def put(self, key, move):
+        self.entries[key] = move
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'hit_rate': self.hit_rate}
+
+
+def board_features(boards):
+    """
+    Heuristic features of a stack of boolean boards of shape (n, rows, cols).
+    Returns an (n, 4) array of lines cleared, holes, aggregate height and bumpiness.
+    """
+    num_rows = boards.shape[1]
+
+    # rows with no empty cell
+    lines_cleared = boards.all(axis=2).sum(axis=1)
+
+    # empty cells with a filled cell anywhere above them
+    covered = np.logical_or.accumulate(boards, axis=1)
+    holes = (covered & ~boards).sum(axis=(1, 2))
+
+    # height of the highest filled cell of every column
+    heights = np.where(covered[:, -1, :], num_rows - boards.argmax(axis=1), 0)
+    aggregate_height = heights.sum(axis=1)
+    bumpiness = np.abs(np.diff(heights, axis=1)).sum(axis=1)
 
-    def lines_cleared(self, resulting_grid):
-        """Counts the number of lines to be cleared in the given grid"""
-        cleared_lines = 0
-        for row in resulting_grid:
-            if (0, 0, 0) not in row:
-                cleared_lines += 1
-        return cleared_lines
-
-    def count_holes(self, resulting_grid):
-        """Counts the number of holes in the given grid"""
-        total_holes = 0
-        num_cols = len(resulting_grid[0])
-        for col_idx in range(num_cols):
-            block_found = False
-            for row_idx in range(len(resulting_grid)):
-                if resulting_grid[row_idx][col_idx] != (0, 0, 0):
-                    block_found = True
-                elif block_found and resulting_grid[row_idx][col_idx] == (0, 0, 0):
-                    total_holes += 1
-        return total_holes
-
-    def get_aggregate_height(self, resulting_grid):
-        """Sum of the column height"""
-        heights = self.get_column_heights(resulting_grid)
-        return sum(heights)
-
-    def get_column_heights(self, resulting_grid):
-        """All column heights"""
-        num_rows = len(resulting_grid)
-        num_cols = len(resulting_grid[0])
-        heights = [0] * num_cols
-        for col_idx in range(num_cols):
-            for row_idx in range(num_rows):
-                if resulting_grid[row_idx][col_idx] != (0, 0, 0):
-                    heights[col_idx] = num_rows - row_idx
-                    break
-        return heights
-
-    
-    def get_bumpiness(self, resulting_grid):
-        """The total difference in height between columns"""
-        heights = self.get_column_heights(resulting_grid)
-        total_bumpiness = 0
-        for i in range(len(heights) - 1):
-            total_bumpiness += abs(heights[i] - heights[i+1])
-        return total_bumpiness
+    return np.stack([lines_cleared, holes, aggregate_height, bumpiness], axis=1)
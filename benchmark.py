@@ -0,0 +1,201 @@
+"""
+Benchmarks for the simulation and agent hot paths.
+
+Every benchmark runs on fixed boards and seeded piece sequences, so numbers
+from different commits can be compared directly. Results are printed as JSON
+and can be saved and compared against an earlier run:
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --compare before.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+from agent import TetrisAgent
+from board import Board
+from evaluation import make_evaluator
+from rules import Piece, PieceBag, shapes, col, row, convert_shape_format, valid_space, clear_rows, \
+    create_grid, get_game_state
+from Tetris import main as run_tetris_game
+
+WEIGHTS = np.array([0.55580476, 0.83967109, 0.32826192, 0.26066793])
+SHORT_GAME_WEIGHTS = np.array([0.9, 0.2, 0.3, 0.6])  # weak weights, their games end after ~100 pieces
+SEED = 1234
+
+
+def make_board(filled_rows, seed=SEED):
+    """Board with the bottom filled_rows rows filled except for one or two random gaps per row."""
+    rng = random.Random(seed)
+    board = Board(col, row)
+    for y in range(row - filled_rows, row):
+        bits = board.full_row
+        for _ in range(rng.randint(1, 2)):
+            bits &= ~(1 << rng.randrange(col))
+        board.place([(0, bits)], 0, y, (128, 128, 128))
+    return board
+
+
+FIXTURES = {
+    'empty': lambda: make_board(0),
+    'mid_game': lambda: make_board(8),
+    'near_top_out': lambda: make_board(16),
+}
+
+
+def piece_sequence(count, seed=SEED):
+    bag = PieceBag(random.Random(seed))
+    return [bag.get_shape() for _ in range(count)]
+
+
+def measure(func, min_time=0.2, repeats=3):
+    """Calls func until min_time has passed, repeats that and returns the best calls per second."""
+    best = 0.0
+    for _ in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+        best = max(best, calls / elapsed)
+    return best
+
+
+def bench_shapes(results, min_time):
+    pieces = [Piece(5, 10, shape) for shape in shapes]
+    for piece in pieces:
+        piece.rotation = 1
+    results['convert_shape_format'] = {
+        'calls_per_sec': measure(lambda: [convert_shape_format(piece) for piece in pieces], min_time) * len(pieces)}
+
+
+def bench_board(results, name, board, min_time):
+    # pieces resting just above the stack, where the game checks them the most
+    pieces = piece_sequence(7)
+    for piece in pieces:
+        piece.y = row - max(board.heights) - 1
+    results[f'valid_space[{name}]'] = {
+        'calls_per_sec': measure(lambda: [valid_space(piece, board) for piece in pieces], min_time) * len(pieces)}
+    results[f'create_grid[{name}]'] = {'calls_per_sec': measure(lambda: create_grid(board), min_time)}
+
+    # fill up the bottom row so there is always a row to clear
+    full_board = board.copy()
+    full_board.place([(0, full_board.full_row)], 0, row - 1)
+    results[f'clear_rows[{name}]'] = {'calls_per_sec': measure(lambda: clear_rows(full_board.copy()), min_time)}
+
+    agent = TetrisAgent(weights=WEIGHTS)
+    pieces = piece_sequence(70)
+    states = [get_game_state(piece, next_piece, board) for piece, next_piece in zip(pieces, pieces[1:])]
+    results[f'choose_action[{name}]'] = {
+        'decisions_per_sec': measure(lambda: [agent.choose_action(state) for state in states], min_time) * len(states)}
+
+    lookahead_agent = TetrisAgent(weights=WEIGHTS, lookahead_depth=2, beam_width=3)
+    results[f'choose_action_lookahead[{name}]'] = {
+        'decisions_per_sec': measure(lambda: [lookahead_agent.choose_action(state) for state in states[:7]],
+                                     min_time) * 7}
+
+
+def bench_games(results, games):
+    """Full training games with short-lived weights, one per seed."""
+    class CountingAgent(TetrisAgent):
+        placements = 0
+
+        def choose_action(self, game_state):
+            CountingAgent.placements += 1
+            return super().choose_action(game_state)
+
+    start = time.perf_counter()
+    for seed in range(games):
+        run_tetris_game(agent=CountingAgent(weights=SHORT_GAME_WEIGHTS), is_training=True,
+                        direct_placement=True, seed=SEED + seed)
+    elapsed = time.perf_counter() - start
+    results['game'] = {'games_per_sec': games / elapsed, 'placements_per_sec': CountingAgent.placements / elapsed}
+
+
+def bench_generation(results, population, backends):
+    """Wall time of evaluating one generation of fixed agents with each evaluation backend."""
+    rng = np.random.RandomState(SEED)
+    tasks = [(SHORT_GAME_WEIGHTS + rng.uniform(-0.05, 0.05, 4), SEED + i) for i in range(population)]
+    for backend in backends:
+        with make_evaluator(backend) as evaluator:
+            if backend in ('pool', 'sharded'):
+                evaluator.evaluate(tasks[:1])  # start the workers outside of the timing
+            start = time.perf_counter()
+            evaluator.evaluate(tasks)
+            results[f'generation[{backend}]'] = {'seconds': time.perf_counter() - start}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmarks(min_time=0.2, games=20, population=20, backends=('sequential', 'batched')):
+    results = {}
+    bench_shapes(results, min_time)
+    for name, make_fixture in FIXTURES.items():
+        bench_board(results, name, make_fixture(), min_time)
+    bench_games(results, games)
+    bench_generation(results, population, backends)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """
+    Prints the change of every metric against the baseline.
+    Returns the names of the metrics that got worse by more than threshold.
+    """
+    regressions = []
+    for name, metrics in report['results'].items():
+        for metric, value in metrics.items():
+            old = baseline['results'].get(name, {}).get(metric)
+            if not old:
+                continue
+            # seconds are better when lower, rates when higher
+            change = (old - value) / old if metric == 'seconds' else (value - old) / old
+            flag = ''
+            if change < -threshold:
+                regressions.append(f'{name}.{metric}')
+                flag = '  <-- regression'
+            print(f'{name:40s} {metric:20s} {old:14.2f} -> {value:14.2f} ({change:+.1%}){flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Tetris simulation and agent.')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown reported as a regression')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent on each measurement')
+    parser.add_argument('--games', type=int, default=20, help='games played for the game benchmark')
+    parser.add_argument('--population', type=int, default=20, help='agents in the generation benchmark')
+    parser.add_argument('--backends', nargs='+', default=['sequential', 'batched'],
+                        help='evaluation backends timed by the generation benchmark')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.min_time, args.games, args.population, args.backends)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
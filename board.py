@@ -0,0 +1,223 @@
+"""
+Bitboard representation of the Tetris playfield.
+
+Each row is stored as an integer where bit x is set when column x is filled,
+so collision, landing, full-row detection and row collapse are all done with
+bit operations. Colors are kept in a separate layer that is only read when
+the board is drawn.
+
+The board also keeps the features the agent scores boards with (column
+heights, holes, row fill counts and bumpiness) up to date as pieces lock and
+rows clear, so the features after a candidate placement can be worked out
+from the few columns the piece covers.
+"""
+
+EMPTY_COLOR = (0, 0, 0)
+
+
+class Board:
+    def __init__(self, width=10, height=20):
+        self.width = width
+        self.height = height
+        self.full_row = (1 << width) - 1
+        self.rows = [0] * height
+        self.colors = [[EMPTY_COLOR] * width for _ in range(height)]
+
+        # features
+        self.heights = [0] * width  # height of the highest filled cell of every column
+        self.filled = [0] * width  # filled cells of every column
+        self.holes = [0] * width  # empty cells below the highest filled cell of every column
+        self.row_fill = [0] * height  # filled cells of every row
+        self.aggregate_height = 0
+        self.total_holes = 0
+        self.bumpiness = 0
+
+    def copy(self, colors=True):
+        """Returns an independent copy of the board, without the color layer if colors is False."""
+        board = Board.__new__(Board)
+        board.width = self.width
+        board.height = self.height
+        board.full_row = self.full_row
+        board.rows = self.rows[:]
+        board.colors = [line[:] for line in self.colors] if colors and self.colors is not None else None
+        board.heights = self.heights[:]
+        board.filled = self.filled[:]
+        board.holes = self.holes[:]
+        board.row_fill = self.row_fill[:]
+        board.aggregate_height = self.aggregate_height
+        board.total_holes = self.total_holes
+        board.bumpiness = self.bumpiness
+        return board
+
+    def key(self):
+        """All the rows packed into a single integer, two boards with the same cells have the same key."""
+        key = 0
+        for bits in self.rows:
+            key = key << self.width | bits
+        return key
+
+    def fits(self, masks, left, top):
+        """
+        Checks if a piece fits on the board.
+
+        masks is a list of (row_offset, bits) pairs where bit j of bits is a
+        filled cell in column left + j. Rows above the board are not checked,
+        matching the behaviour of pieces that spawn partially above the grid.
+        """
+        rows = self.rows
+        for dy, bits in masks:
+            y = top + dy
+            if y < 0:
+                continue
+            if y >= self.height:
+                return False
+            if left >= 0:
+                bits <<= left
+                if bits > self.full_row:
+                    return False
+            else:
+                if bits & ((1 << -left) - 1):
+                    return False
+                bits >>= -left
+            if rows[y] & bits:
+                return False
+        return True
+
+    def drop(self, masks, left, top):
+        """
+        Moves a piece down from top until it can't go any further.
+        Returns the row offset of the last position that fits, which is
+        top - 1 if the piece doesn't fit at top at all.
+        """
+        while self.fits(masks, left, top):
+            top += 1
+        return top - 1
+
+    def place(self, masks, left, top, color=None):
+        """Locks the piece cells that fall inside the board."""
+        rows = self.rows
+        heights = self.heights
+        filled = self.filled
+        for dy, bits in masks:
+            y = top + dy
+            if not 0 <= y < self.height:
+                continue
+            bits = (bits << left if left >= 0 else bits >> -left) & self.full_row & ~rows[y]
+            rows[y] |= bits
+            self.row_fill[y] += bits.bit_count()
+            line = self.colors[y] if self.colors is not None else None
+            x = 0
+            while bits:
+                if bits & 1:
+                    filled[x] += 1
+                    if heights[x] < self.height - y:
+                        heights[x] = self.height - y
+                    if color is not None and line is not None:
+                        line[x] = color
+                bits >>= 1
+                x += 1
+        self.update_totals()
+
+    def column_tops(self):
+        """Row index of the highest filled cell of every column, or the board height for empty columns."""
+        return [self.height - h for h in self.heights]
+
+    def full_rows(self):
+        """Indices of the rows that are completely filled."""
+        return [y for y, fill in enumerate(self.row_fill) if fill == self.width]
+
+    def clear_full_rows(self):
+        """
+        Removes every full row and shifts the rows above it down.
+        Returns the number of rows cleared.
+        """
+        full = self.full_rows()
+        if full:
+            for y in reversed(full):
+                del self.rows[y]
+                del self.row_fill[y]
+                if self.colors is not None:
+                    del self.colors[y]
+            self.rows[:0] = [0] * len(full)
+            self.row_fill[:0] = [0] * len(full)
+            if self.colors is not None:
+                self.colors[:0] = [[EMPTY_COLOR] * self.width for _ in full]
+
+            # every column loses one cell per cleared row, but its highest cell
+            # can end up further down when it was sitting on top of holes
+            self.filled = [count - len(full) for count in self.filled]
+            self.update_heights()
+            self.update_totals()
+        return len(full)
+
+    def set_rows(self, rows):
+        """Replaces all the cells of the board with the given row masks and recomputes the features."""
+        self.rows = list(rows)
+        self.row_fill = [bits.bit_count() for bits in self.rows]
+        self.filled = [sum(bits >> x & 1 for bits in self.rows) for x in range(self.width)]
+        self.update_heights()
+        self.update_totals()
+
+    def update_heights(self):
+        """Recomputes the height of every column from the rows."""
+        self.heights = [0] * self.width
+        covered = 0
+        for y, bits in enumerate(self.rows):
+            new_bits = bits & ~covered
+            if new_bits:
+                for x in range(self.width):
+                    if new_bits >> x & 1:
+                        self.heights[x] = self.height - y
+                covered |= new_bits
+                if covered == self.full_row:
+                    break
+
+    def update_totals(self):
+        """Recomputes the holes of every column and the board totals from the heights and fill counts."""
+        heights = self.heights
+        self.holes = [height - count for height, count in zip(heights, self.filled)]
+        self.aggregate_height = sum(heights)
+        self.total_holes = sum(self.holes)
+        self.bumpiness = sum(abs(heights[x] - heights[x + 1]) for x in range(self.width - 1))
+
+    def placement_features(self, columns, row_counts, x, y):
+        """
+        Features of the board after locking a piece at (x, y), before any rows
+        are cleared: lines cleared, holes, aggregate height and bumpiness.
+        The board itself is left unchanged.
+
+        columns holds (column, top row, cells) for every column the piece
+        covers, left to right, and row_counts holds (row, cells) for every row
+        it covers, both relative to (x, y). Only those columns, their direct
+        neighbours and those rows are looked at.
+        """
+        lines_cleared = 0
+        for dy, count in row_counts:
+            if self.row_fill[y + dy] + count == self.width:
+                lines_cleared += 1
+
+        heights = self.heights
+        holes = self.total_holes
+        aggregate_height = self.aggregate_height
+        new_heights = []
+        for dx, top_dy, count in columns:
+            old_height = heights[x + dx]
+            new_height = max(old_height, self.height - y - top_dy)
+            new_heights.append(new_height)
+            aggregate_height += new_height - old_height
+            # the column grows by new_height - old_height cells, count of which are filled by the piece
+            holes += new_height - old_height - count
+
+        # height differences between a covered column and its right neighbour, and left of the first one
+        bumpiness = self.bumpiness
+        first = x + columns[0][0]
+        last = first + len(new_heights) - 1
+        if first > 0:
+            bumpiness += abs(heights[first - 1] - new_heights[0]) - abs(heights[first - 1] - heights[first])
+        for i in range(len(new_heights) - 1):
+            bumpiness += (abs(new_heights[i] - new_heights[i + 1]) -
+                          abs(heights[first + i] - heights[first + i + 1]))
+        if last < self.width - 1:
+            bumpiness += abs(new_heights[-1] - heights[last + 1]) - abs(heights[last] - heights[last + 1])
+
+        return lines_cleared, holes, aggregate_height, bumpiness
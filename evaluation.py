@@ -0,0 +1,364 @@
+"""
+Fitness evaluation backends for the genetic algorithm.
+
+A task is a (weights, seed) pair: one headless AI game with the given agent
+weights on the piece sequence of the given seed. A third element, if present,
+is the piece budget of the game. Every backend takes a list of tasks and
+returns the scores in the same order, and the score of a task only depends on
+the task itself, so all backends agree with each other. Time limits are the
+exception: where a game is cut off depends on the speed of the machine.
+"""
+import math
+import os
+import json
+import multiprocessing
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from agent import TetrisAgent
+from instrumentation import PhaseTimer, clock
+from metrics import game_record
+from sharding import ShardedRunner
+from Tetris import main as run_tetris_game
+from vector_env import NO_BUDGET, VectorTetris, run_batch
+
+# Bump whenever the rules, the scoring or the agent's decisions change, so
+# scores cached by an older version of the game are never reused
+GAME_CONFIG_VERSION = 1
+
+
+def play_game(weights, seed, collect_stats=False, max_pieces=None, time_limit=None):
+    """
+    Plays one training game and returns its score. With collect_stats, returns a dictionary of
+    the score, lines cleared, pieces placed, seconds taken and the phase timings instead.
+    The game ends early once it has placed max_pieces pieces or run for time_limit seconds.
+    """
+    agent = TetrisAgent(weights=np.asarray(weights, dtype=float))
+    if not collect_stats:
+        return run_tetris_game(agent=agent, is_training=True, direct_placement=True, seed=seed,
+                               max_pieces=max_pieces, time_limit=time_limit)
+
+    start = clock()
+    score, timings = run_tetris_game(agent=agent, is_training=True, direct_placement=True, seed=seed,
+                                     timer=PhaseTimer(), max_pieces=max_pieces, time_limit=time_limit)
+    return {
+        'score': score,
+        'lines': timings['counts'].get('lines', 0),
+        'pieces': timings['counts'].get('pieces', 0),
+        'seconds': clock() - start,
+        'timings': timings,
+    }
+
+
+def split_task(task):
+    """Weights, seed and piece budget of a task, the budget is None when the task has none."""
+    if len(task) == 3:
+        return task
+    weights, seed = task
+    return weights, seed, None
+
+
+def play_task(task, collect_stats=False, time_limit=None):
+    weights, seed, max_pieces = split_task(task)
+    return play_game(weights, seed, collect_stats, max_pieces, time_limit)
+
+
+class SequentialEvaluator:
+    """
+    Plays the games one after another in this process.
+    With collect_timings, the phase timings of every game are added up in self.timings,
+    and with a metrics log, a record of every game played is written to it.
+    Every game ends after time_limit seconds if one is given.
+    """
+    def __init__(self, collect_timings=False, metrics=None, time_limit=None):
+        self.timings = PhaseTimer() if collect_timings else None
+        self.metrics = metrics
+        self.time_limit = time_limit
+
+    @property
+    def collect_stats(self):
+        return self.timings is not None or self.metrics is not None
+
+    def evaluate(self, tasks):
+        return self.collect(tasks, [play_task(task, self.collect_stats, self.time_limit) for task in tasks])
+
+    def collect(self, tasks, results):
+        """Adds up the timings of the games' stats, logs the games and returns their scores."""
+        if not self.collect_stats:
+            return results
+        for task, stats in zip(tasks, results):
+            if self.timings is not None and stats['timings'] is not None:
+                self.timings.merge(stats['timings'])
+            if self.metrics is not None:
+                weights, seed, max_pieces = split_task(task)
+                self.metrics.write(game_record(weights, seed, stats, max_pieces))
+        return [stats['score'] for stats in results]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PoolEvaluator(SequentialEvaluator):
+    """
+    Spreads the games over a pool of worker processes.
+    Workers are spawned fresh, so they only import the game rules and never
+    inherit a pygame display or matplotlib state from the parent.
+    """
+    def __init__(self, workers=None, collect_timings=False, metrics=None, time_limit=None):
+        super().__init__(collect_timings, metrics, time_limit)
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+
+    def evaluate(self, tasks):
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        tasks = [(tuple(float(w) for w in weights), seed, max_pieces) for weights, seed, max_pieces in map(split_task, tasks)]
+        play = partial(play_task, collect_stats=self.collect_stats, time_limit=self.time_limit)
+        return self.collect(tasks, list(self.executor.map(play, tasks)))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class BatchedEvaluator(SequentialEvaluator):
+    """Plays all the games in one lockstep batch. The time limit applies to the whole batch."""
+    def evaluate(self, tasks):
+        if not tasks:
+            return []
+        tasks = [split_task(task) for task in tasks]
+        weights = np.array([weights for weights, seed, max_pieces in tasks], dtype=float)
+        seeds = [seed for weights, seed, max_pieces in tasks]
+        budgets = [max_pieces if max_pieces is not None else NO_BUDGET for weights, seed, max_pieces in tasks]
+        if not self.collect_stats:
+            return run_batch(weights, seeds, max_pieces=budgets, time_limit=self.time_limit).tolist()
+
+        # the games run in lockstep, so only their lines and pieces are known one by one
+        game = VectorTetris(weights, seeds, timer=self.timings, max_pieces=budgets)
+        scores = game.run(self.time_limit).tolist()
+        results = [{'score': score, 'lines': int(lines), 'pieces': int(pieces), 'seconds': None, 'timings': None}
+                   for score, lines, pieces in zip(scores, game.lines, game.pieces_placed)]
+        return self.collect(tasks, results)
+
+
+class ShardedEvaluator(SequentialEvaluator):
+    """
+    Plays all the games in lockstep batches spread over worker processes, one shard per worker,
+    with the games kept in shared memory. The time limit applies to every shard.
+    """
+    def __init__(self, workers=None, collect_timings=False, metrics=None, time_limit=None):
+        super().__init__(collect_timings, metrics, time_limit)
+        self.runner = ShardedRunner(workers)
+
+    def evaluate(self, tasks):
+        if not tasks:
+            return []
+        tasks = [split_task(task) for task in tasks]
+        weights = np.array([weights for weights, seed, max_pieces in tasks], dtype=float)
+        seeds = [seed for weights, seed, max_pieces in tasks]
+        budgets = [max_pieces if max_pieces is not None else NO_BUDGET for weights, seed, max_pieces in tasks]
+        scores, lines, pieces = self.runner.run(weights, seeds, budgets, self.time_limit, self.timings)
+        if not self.collect_stats:
+            return scores.tolist()
+
+        results = [{'score': score, 'lines': int(game_lines), 'pieces': int(game_pieces), 'seconds': None,
+                    'timings': None} for score, game_lines, game_pieces in zip(scores.tolist(), lines, pieces)]
+        return self.collect(tasks, results)
+
+    def close(self):
+        self.runner.close()
+
+
+class CachedEvaluator(SequentialEvaluator):
+    """
+    Remembers the score of every task it has evaluated and only passes new
+    tasks on to the wrapped evaluator. Scores are keyed by the weights rounded
+    to a fixed number of decimals, the seed, the piece budget and GAME_CONFIG_VERSION, and the
+    least recently used ones are dropped once max_size is reached. If a path
+    is given, the cache is loaded from it and saved back to it on close.
+    """
+    def __init__(self, evaluator, max_size=100000, path=None, decimals=9):
+        self.evaluator = evaluator
+        self.max_size = max_size
+        self.path = path
+        self.decimals = decimals
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.timings = evaluator.timings
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def key(self, task):
+        weights, seed, max_pieces = split_task(task)
+        weights = tuple(round(float(w), self.decimals) for w in weights)
+        return weights, int(seed), max_pieces, GAME_CONFIG_VERSION
+
+    def evaluate(self, tasks):
+        keys = [self.key(task) for task in tasks]
+
+        # evaluate each missing task once, even if it appears several times
+        missing = {}
+        for key, task in zip(keys, tasks):
+            if key in self.scores:
+                self.scores.move_to_end(key)
+                self.hits += 1
+            elif key in missing:
+                self.hits += 1
+            else:
+                missing[key] = task
+                self.misses += 1
+
+        new_scores = dict(zip(missing, self.evaluator.evaluate(list(missing.values()))))
+        results = [new_scores[key] if key in new_scores else self.scores[key] for key in keys]
+
+        for key, score in new_scores.items():
+            self.scores[key] = score
+        while len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+
+        return results
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            for entry in json.load(f):
+                # entries written before piece budgets have no budget
+                weights, seed, max_pieces, version, score = entry if len(entry) == 5 else entry[:2] + [None] + entry[2:]
+                if version == GAME_CONFIG_VERSION:
+                    self.scores[tuple(weights), seed, max_pieces, version] = score
+
+    def save(self):
+        """Writes the cache to a temporary file and moves it over the old one."""
+        entries = [[list(weights), seed, max_pieces, version, score]
+                   for (weights, seed, max_pieces, version), score in self.scores.items()]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        if self.path is not None:
+            self.save()
+        self.evaluator.close()
+
+
+class RacingEvaluator(SequentialEvaluator):
+    """
+    Successive halving over the agents of a list of tasks. Tasks with the same
+    weights belong to one agent. Every agent plays the first stage, a few games
+    with a small piece budget, and only the best keep_fraction of them go on to
+    the next stage with a larger budget and more games, so long games are only
+    played by the agents that are worth it.
+
+    Every task of an agent gets the agent's average score in the last stage it
+    played. Those scores come from different games and budgets, so they don't
+    rank agents that dropped out at different stages: after evaluate,
+    stages_reached holds the last stage of every task's agent, and agents
+    should be ranked by (stages_reached, score), see ranking_keys.
+    """
+    def __init__(self, evaluator, stages, keep_fraction=0.5):
+        """
+        Args:
+            evaluator: Evaluator that plays the games of every stage.
+            stages: (max_pieces, games) of every stage, max_pieces None for no budget. An agent
+                plays its first games tasks in a stage, or all of them if games is None. Every agent
+                needs at least games tasks.
+            keep_fraction: Share of the agents that goes on to the next stage, at least one always does.
+        """
+        self.evaluator = evaluator
+        self.stages = stages
+        self.keep_fraction = keep_fraction
+        self.timings = evaluator.timings
+        self.stages_reached = []  # last stage of every task's agent in the last evaluate
+
+    def evaluate(self, tasks):
+        agents = OrderedDict()
+        owners = []
+        for task in tasks:
+            weights, seed, max_pieces = split_task(task)
+            agent = tuple(float(w) for w in weights)
+            agents.setdefault(agent, []).append((weights, seed))
+            owners.append(agent)
+
+        tasks_per_agent = min((len(agent_tasks) for agent_tasks in agents.values()), default=0)
+        for max_pieces, games in self.stages:
+            if games is not None and games > tasks_per_agent:
+                raise ValueError(f"A racing stage plays {games} games per agent, "
+                                 f"but some agents only have {tasks_per_agent} tasks")
+
+        fitness = {}
+        reached = {}
+        racing = list(agents)
+        for stage, (max_pieces, games) in enumerate(self.stages):
+            stage_tasks = []
+            stage_owners = []
+            for agent in racing:
+                for weights, seed in agents[agent][:games]:
+                    stage_tasks.append((weights, seed, max_pieces))
+                    stage_owners.append(agent)
+
+            scores = defaultdict(list)
+            for agent, score in zip(stage_owners, self.evaluator.evaluate(stage_tasks)):
+                scores[agent].append(score)
+            for agent in racing:
+                fitness[agent] = float(np.mean(scores[agent]))
+                reached[agent] = stage
+
+            if stage < len(self.stages) - 1:
+                keep = max(1, math.ceil(len(racing) * self.keep_fraction))
+                racing = sorted(racing, key=lambda agent: fitness[agent], reverse=True)[:keep]
+
+        self.stages_reached = [reached[agent] for agent in owners]
+        return [fitness[agent] for agent in owners]
+
+    def close(self):
+        self.evaluator.close()
+
+
+def ranking_keys(evaluator, fitness, games=1):
+    """
+    Sort keys that rank agents by their fitness, one per agent, for agents that played games
+    consecutive tasks each in the evaluator's last evaluate. Agents raced by a RacingEvaluator
+    are ranked by the last stage they reached first.
+    """
+    stages = getattr(evaluator, 'stages_reached', None)
+    if not stages:
+        return [(0, score) for score in fitness]
+    return [(stages[i * games], score) for i, score in enumerate(fitness)]
+
+
+def make_evaluator(backend='sequential', workers=None, cache_size=0, cache_path=None, collect_timings=False,
+                   metrics=None, time_limit=None, racing_stages=None, racing_keep_fraction=0.5):
+    """
+    Creates a 'sequential', 'pool', 'batched' or 'sharded' evaluator, wrapped in a
+    CachedEvaluator when cache_size is positive. Games it plays are logged
+    to metrics if a MetricsLog is given, games found in the cache are not.
+    Games that end at the time limit don't score the same every time, so there
+    is no cache with a time limit. With racing_stages, the evaluator races the
+    agents through those stages, see RacingEvaluator.
+    """
+    if backend == 'sequential':
+        evaluator = SequentialEvaluator(collect_timings, metrics, time_limit)
+    elif backend == 'pool':
+        evaluator = PoolEvaluator(workers, collect_timings, metrics, time_limit)
+    elif backend == 'batched':
+        evaluator = BatchedEvaluator(collect_timings, metrics, time_limit)
+    elif backend == 'sharded':
+        evaluator = ShardedEvaluator(workers, collect_timings, metrics, time_limit)
+    else:
+        raise ValueError(f"Unknown evaluation backend: {backend}")
+
+    if cache_size > 0 and time_limit is None:
+        evaluator = CachedEvaluator(evaluator, cache_size, cache_path)
+    if racing_stages:
+        evaluator = RacingEvaluator(evaluator, racing_stages, racing_keep_fraction)
+    return evaluator
@@ -1,25 +1,61 @@
+import os
 import random
+import multiprocessing
+import traceback
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 import re
 from agent import TetrisAgent
-from Tetris import main as run_tetris_game
+from evaluation import make_evaluator, ranking_keys, SequentialEvaluator
+from metrics import MetricsLog, generation_record, history_from_metrics
+from optimizers import CMAES, optimize
 
 # --- Genetic Algorithm Parameters ---
 POPULATION_SIZE = 50
 NUM_GENERATIONS = 50
 MUTATION_RATE = 0.1
 MUTATION_STRENGTH = 0.1
+EVALUATION_BACKEND = 'sequential'  # 'sequential', 'pool' (worker processes), 'batched' (one lockstep batch)
+                                  # or 'sharded' (lockstep batches on worker processes, in shared memory)
+NUM_WORKERS = None  # size of the worker pool or number of shards, defaults to the number of CPUs
+FITNESS_CACHE_SIZE = 100000  # scores remembered per (weights, seed), 0 disables the cache
+FITNESS_CACHE_PATH = 'fitness_cache.json'  # file the cache is kept in between runs, None keeps it in memory
+GAMES_PER_AGENT = 1  # games each agent plays per generation, fitness is their average score
+COMMON_RANDOM_NUMBERS = False  # every agent in a generation plays the same piece sequences
+COLLECT_TIMINGS = False  # time the phases of every game and print them per generation
+CHECKPOINT_PATH = 'checkpoint.npz'  # file training state is saved to, train(resume=...) continues from it
+CHECKPOINT_INTERVAL = 1  # generations between checkpoints
+METRICS_PATH = 'training_metrics.jsonl'  # log of every game and generation, None disables it
+MAX_PIECES = None  # piece budget of every game, None plays until top-out
+TIME_LIMIT = None  # seconds a game may take, None for no limit; fitness then depends on machine speed
+RACING_STAGES = None  # (max_pieces, games) stages agents race through, e.g. [(200, 1), (1000, 2), (5000, None)];
+                     # a stage's games can't be more than GAMES_PER_AGENT
+RACING_KEEP_FRACTION = 0.5  # share of the agents that goes on to the next racing stage
+CMAES_SIGMA = 0.25  # starting step size of train_cmaes
+CMAES_POPULATION_SIZE = None  # candidates per CMA-ES generation, None for the default 4 + 3 ln(4)
+NUM_ISLANDS = 4  # sub-populations of train_islands, each evolving in its own process
+MIGRATION_INTERVAL = 5  # generations between migrations from one island to the next
+NUM_MIGRANTS = 2  # best agents every island sends to the next one at a migration
+MIN_ISLAND_SIZE = 5  # fewest agents an island can evolve, a fifth of them are the parents
 
 
 class GeneticAlgorithm:
-    def __init__(self):
+    def __init__(self, evaluator=None, population_size=POPULATION_SIZE):
+        self.evaluator = evaluator if evaluator is not None else SequentialEvaluator()
+        self.population_size = population_size
         self.population = self.initialize_population()
+        # piece sequence seeds of every agent, None until the agent has played
+        self.seeds = [None] * len(self.population)
+        # fitness and phase timings of the last generation, timings are None unless the evaluator collects them
+        self.fitness = None
+        self.timings = None
+        # weights of the last generation's agents, best first
+        self.ranked_weights = []
 
     def initialize_population(self):
         """Creates an initial population of agents with random weights."""
         population = []
-        for _ in range(POPULATION_SIZE):
+        for _ in range(self.population_size):
             # Weights are initialized between 0 and 1f
             # weights = np.array([0.37831685, 0.49987323, 0.51730053, 0.14835932])
             weights = np.random.rand(4)
@@ -32,13 +68,21 @@ class GeneticAlgorithm:
         Returns key scores and metrics for the generation.
         """
         # 1. Evaluate Fitness
-        fitness_scores = []
-        for i, agent in enumerate(self.population):
-            print(f"  - Running game for agent {i + 1}/{POPULATION_SIZE}...")
-            # The fitness is the score returned by the game
-            score = run_tetris_game(is_training=True, agent=agent)
-            fitness_scores.append(score)
-            print(f"    Agent {i + 1} finished with score: {score}")
+        seeds = self.draw_seeds()
+        tasks = [(agent.weights, seed, MAX_PIECES) for agent, agent_seeds in zip(self.population, seeds)
+                 for seed in agent_seeds]
+        scores = self.evaluator.evaluate(tasks)
+        # The fitness is the average score of the games played by the agent
+        fitness_scores = [float(np.mean(scores[i * GAMES_PER_AGENT:(i + 1) * GAMES_PER_AGENT]))
+                          for i in range(len(self.population))]
+        self.fitness = fitness_scores
+
+        timer = getattr(self.evaluator, 'timings', None)
+        if timer is not None:
+            self.timings = timer.report()
+            print("  - Time per phase:")
+            print(timer.summary())
+            timer.reset()
 
         # --- Calculate and store metrics for plotting ---
         best_score = np.max(fitness_scores)
@@ -50,33 +94,64 @@ class GeneticAlgorithm:
         weight_std_dev = np.std(all_weights, axis=0)
 
         # 2. Selection
-        population_with_scores = sorted(zip(self.population, fitness_scores), key=lambda x: x[1], reverse=True)
+        # agents are ranked by their fitness, and raced agents first by the last stage they reached
+        ranking = ranking_keys(self.evaluator, fitness_scores, GAMES_PER_AGENT)
+        population_with_scores = sorted(zip(self.population, ranking), key=lambda x: x[1], reverse=True)
+        self.ranked_weights = [agent.weights for agent, key in population_with_scores]
 
-        num_parents = POPULATION_SIZE // 5
-        parents = [agent for agent, score in population_with_scores[:num_parents]]
+        num_parents = max(1, self.population_size // 5)
+        parents = [agent for agent, key in population_with_scores[:num_parents]]
 
         # 3. Crossover and Mutation
         next_generation = []
+        next_seeds = []
 
         # Elitism: Keep the best agent from the current generation
         if parents:
             best_agent_this_gen = population_with_scores[0][0]
             next_generation.append(best_agent_this_gen)
+            next_seeds.append(seeds[self.population.index(best_agent_this_gen)])
 
         # Create the rest of the new population
-        while len(next_generation) < POPULATION_SIZE:
+        while len(next_generation) < self.population_size:
             parent1 = random.choice(parents)
             parent2 = random.choice(parents)
 
             child_weights = self.crossover(parent1.weights, parent2.weights)
             mutated_child_weights = self.mutate(child_weights)
             next_generation.append(TetrisAgent(weights=mutated_child_weights))
+            next_seeds.append(None)
 
         self.population = next_generation
+        self.seeds = next_seeds
 
         # Return all relevant metrics for this generation
         return best_score, avg_score, worst_score, best_agent_this_gen.weights, weight_std_dev
 
+    def emigrants(self, count):
+        """Weights of the best count agents of the last generation."""
+        return [np.copy(weights) for weights in self.ranked_weights[:count]]
+
+    def immigrate(self, weights):
+        """Replaces the last agents of the population with agents of the given weights, keeping the elite first."""
+        start = max(1, len(self.population) - len(weights))
+        for index, agent_weights in zip(range(start, len(self.population)), weights):
+            self.population[index] = TetrisAgent(weights=np.array(agent_weights, dtype=float))
+            self.seeds[index] = None
+
+    def draw_seeds(self):
+        """
+        Piece sequence seeds of every agent's games for this generation.
+        With common random numbers all agents play the same sequences, so differences in
+        fitness come from the weights and not from the luck of the draw. Otherwise every agent
+        gets its own seeds, and agents carried over from the last generation keep theirs.
+        """
+        if COMMON_RANDOM_NUMBERS:
+            shared_seeds = [random.randrange(2**32) for _ in range(GAMES_PER_AGENT)]
+            return [shared_seeds] * len(self.population)
+        return [agent_seeds if agent_seeds is not None else [random.randrange(2**32) for _ in range(GAMES_PER_AGENT)]
+                for agent_seeds in self.seeds]
+
     def crossover(self, weights1, weights2):
         """Performs single-point crossover between two parent weight vectors."""
         crossover_point = random.randint(1, len(weights1) - 1)
@@ -134,6 +209,7 @@ class GeneticAlgorithm:
 
 def plot_genetic_diversity(history):
     """Plots the standard deviation of weights in the population over generations."""
+    import matplotlib.pyplot as plt
     diversity_history = np.array([h['diversity'] for h in history])
     generations = range(1, len(history) + 1)
 
@@ -172,34 +248,277 @@ def parse_weights_from_file(filepath='generation_weights.txt'):
     return history
 
 
-def train():
-    """Main function to run the training process."""
-    ga = GeneticAlgorithm()
+def train(resume=None):
+    """
+    Main function to run the training process.
+    With resume set to the path of a checkpoint, training continues exactly where that checkpoint left off.
+    """
+    metrics = MetricsLog(METRICS_PATH, resume=resume is not None) if METRICS_PATH else None
+    try:
+        with make_evaluator(EVALUATION_BACKEND, NUM_WORKERS, FITNESS_CACHE_SIZE, FITNESS_CACHE_PATH, COLLECT_TIMINGS,
+                            metrics, TIME_LIMIT, RACING_STAGES, RACING_KEEP_FRACTION) as evaluator:
+            ga = GeneticAlgorithm(evaluator)
+            history = []
+            start_generation = 0
+            if resume is not None:
+                history, start_generation = load_checkpoint(resume, ga)
+                print(f"--- Resuming from {resume} at generation {start_generation + 1} ---")
+            history = run_training(ga, history, start_generation, metrics)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    print("\n--- Training Complete. Generating visualizations... ---")
+    plot_training(history)
+
+
+def train_cmaes():
+    """
+    Trains the agent weights with CMA-ES instead of the GA. Uses the same evaluation settings,
+    and every candidate of a generation plays the same GAMES_PER_AGENT games.
+    """
+    metrics = MetricsLog(METRICS_PATH) if METRICS_PATH else None
+    try:
+        with make_evaluator(EVALUATION_BACKEND, NUM_WORKERS, FITNESS_CACHE_SIZE, FITNESS_CACHE_PATH, COLLECT_TIMINGS,
+                            metrics, TIME_LIMIT, RACING_STAGES, RACING_KEEP_FRACTION) as evaluator:
+            optimizer = CMAES(np.full(4, 0.5), CMAES_SIGMA, CMAES_POPULATION_SIZE)
+            history = optimize(optimizer, evaluator, NUM_GENERATIONS, GAMES_PER_AGENT, MAX_PIECES, metrics)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    np.save('best_weights.npy', optimizer.mean)
+    print(f"\n--- Training Complete. Final weights: {optimizer.mean} ---")
+    plot_training(history)
+
+
+# settings an island plays and evolves with, passed on from train_islands because
+# a spawned process imports this module afresh and only sees the defaults above
+ISLAND_SETTINGS = ('EVALUATION_BACKEND', 'FITNESS_CACHE_SIZE', 'TIME_LIMIT', 'RACING_STAGES', 'RACING_KEEP_FRACTION',
+                   'GAMES_PER_AGENT', 'MAX_PIECES', 'COMMON_RANDOM_NUMBERS', 'MUTATION_RATE', 'MUTATION_STRENGTH')
+
+
+def run_island(island, population_size, generations, migration_interval, num_migrants, inbox, outbox, results,
+               seed=None, workers=None, settings=None):
+    """
+    Evolves one island of train_islands in a worker process, evaluating on workers processes
+    with the pool and sharded backends. Every migration_interval generations
+    the island sends its best agents to outbox and replaces its last agents with the ones from inbox.
+    settings maps names of ISLAND_SETTINGS to the values of the training process.
+    Puts (island, fitness, weights of the population, best weights) on results after every generation,
+    or (island, None, traceback, None) if the island fails.
+    """
+    try:
+        if settings:
+            globals().update(settings)
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        # islands run at the same time, so they keep their caches to themselves and in memory
+        with make_evaluator(EVALUATION_BACKEND, workers, FITNESS_CACHE_SIZE, None, False, None, TIME_LIMIT,
+                            RACING_STAGES, RACING_KEEP_FRACTION) as evaluator:
+            ga = GeneticAlgorithm(evaluator, population_size)
+            for generation in range(generations):
+                population = np.array([agent.weights for agent in ga.population])
+                best_score, avg_score, worst_score, best_weights, diversity = ga.run_generation(generation)
+                results.put((island, ga.fitness, population, best_weights))
+
+                if (generation + 1) % migration_interval == 0 and generation + 1 < generations:
+                    outbox.put(ga.emigrants(num_migrants))
+                    ga.immigrate(inbox.get())
+    except Exception:
+        results.put((island, None, traceback.format_exc(), None))
+
+
+def train_islands(num_islands=NUM_ISLANDS, migration_interval=MIGRATION_INTERVAL, num_migrants=NUM_MIGRANTS,
+                  seed=None):
+    """
+    Trains the GA as an island model: the population is split into num_islands sub-populations
+    that evolve in their own processes and only meet when the best num_migrants agents of every
+    island move on to the next island in a ring, every migration_interval generations. An island
+    only waits for its neighbour at a migration, never for the slowest game of the whole population.
+    With a seed, island i seeds its random number generators with seed + i. Islands don't write checkpoints.
+    The agents and the NUM_WORKERS evaluation workers are shared out as evenly as possible over the islands.
+    """
+    if POPULATION_SIZE // num_islands < MIN_ISLAND_SIZE:
+        raise ValueError(f"{POPULATION_SIZE} agents are too few for {num_islands} islands, "
+                         f"every island needs at least {MIN_ISLAND_SIZE}")
+    population_sizes = [POPULATION_SIZE // num_islands + (i < POPULATION_SIZE % num_islands)
+                        for i in range(num_islands)]
+    workers = NUM_WORKERS or os.cpu_count()
+    island_workers = [max(1, workers // num_islands + (i < workers % num_islands)) for i in range(num_islands)]
+    settings = {name: globals()[name] for name in ISLAND_SETTINGS}
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(num_islands)]
+    results = context.Queue()
+    islands = [context.Process(target=run_island,
+                               args=(i, population_sizes[i], NUM_GENERATIONS, migration_interval, num_migrants,
+                                     queues[i], queues[(i + 1) % num_islands], results,
+                                     seed + i if seed is not None else None, island_workers[i], settings))
+               for i in range(num_islands)]
+    for process in islands:
+        process.start()
+
+    metrics = MetricsLog(METRICS_PATH) if METRICS_PATH else None
     history = []
+    reports = [[] for _ in range(num_islands)]
+    start = time.perf_counter()
+    try:
+        # a generation is complete once every island has reported it, islands may run ahead of each other
+        while len(history) < NUM_GENERATIONS:
+            island, fitness, population, best_weights = results.get()
+            if fitness is None:
+                raise RuntimeError(f"Island {island} failed:\n{population}")
+            reports[island].append((fitness, population, best_weights))
+            if any(len(report) <= len(history) for report in reports):
+                continue
+
+            generation = [report[len(history)] for report in reports]
+            fitness = np.concatenate([island_fitness for island_fitness, _, _ in generation])
+            best_island = int(np.argmax([max(island_fitness) for island_fitness, _, _ in generation]))
+            history.append({
+                'generation': len(history) + 1,
+                'best_score': np.max(fitness),
+                'avg_score': np.mean(fitness),
+                'worst_score': np.min(fitness),
+                'best_weights': generation[best_island][2],
+                'diversity': np.std(np.concatenate([population for _, population, _ in generation]), axis=0),
+            })
+
+            seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            if metrics is not None:
+                metrics.write(generation_record(history[-1], fitness.tolist(), seconds))
+            print(f"Generation {len(history)}/{NUM_GENERATIONS}: best {history[-1]['best_score']}, "
+                  f"avg {history[-1]['avg_score']:.2f}, best weights {history[-1]['best_weights']} "
+                  f"(island {best_island}, {seconds:.1f}s)")
+            np.save('best_weights.npy', history[-1]['best_weights'])
+    finally:
+        for process in islands:
+            if len(history) < NUM_GENERATIONS:
+                process.terminate()
+            process.join()
+        if metrics is not None:
+            metrics.close()
+
+    print("\n--- Training Complete. Generating visualizations... ---")
+    plot_training(history)
+    return history
+
+
+def plot_training(history):
+    plot_learning_curve(history)
+    plot_weight_evolution(history)
+    plot_genetic_diversity(history)
+
+
+def plot_metrics(path=METRICS_PATH):
+    """Rebuilds the training plots from a metrics log."""
+    plot_training(history_from_metrics(path))
+
+
+def run_training(ga, history=None, start_generation=0, metrics=None):
+    """
+    Runs the remaining generations of the genetic algorithm and returns the history.
+    A checkpoint is written every CHECKPOINT_INTERVAL generations and after the last one,
+    and a record of every generation is written to metrics if a MetricsLog is given.
+    """
+    history = list(history) if history is not None else []
 
-    for generation in range(NUM_GENERATIONS):
-        print(f"--- Starting Generation {generation + 1}/{NUM_GENERATIONS} ---")
+    for generation in range(start_generation, NUM_GENERATIONS):
+        start = time.perf_counter()
         best_score, avg_score, worst_score, best_weights, diversity = ga.run_generation(generation)
 
         history.append({
+            'generation': generation + 1,
             'best_score': best_score,
             'avg_score': avg_score,
             'worst_score': worst_score,
             'best_weights': best_weights,
-            'diversity': diversity
+            'diversity': diversity,
+            'timings': ga.timings
         })
 
+        seconds = time.perf_counter() - start
+        if metrics is not None:
+            metrics.write(generation_record(history[-1], ga.fitness, seconds, ga.timings))
+
         best_agent = ga.population[0]
-        print(f"--- Generation {generation + 1} Complete ---")
-        print(f"    Best Score: {best_score}")
-        print(f"    Avg Score:  {avg_score:.2f}")
-        print(f"    Best Weights: {best_agent.weights}")
+        print(f"Generation {generation + 1}/{NUM_GENERATIONS}: best {best_score}, avg {avg_score:.2f}, "
+              f"best weights {best_agent.weights} ({seconds:.1f}s)")
         np.save('best_weights.npy', best_agent.weights)
 
-    print("\n--- Training Complete. Generating visualizations... ---")
-    plot_learning_curve(history)
-    plot_weight_evolution(history)
-    plot_genetic_diversity(history)
+        if CHECKPOINT_PATH and ((generation + 1) % CHECKPOINT_INTERVAL == 0 or generation + 1 == NUM_GENERATIONS):
+            save_checkpoint(CHECKPOINT_PATH, ga, history, generation + 1)
+
+    return history
+
+
+HISTORY_FIELDS = ['generation', 'best_score', 'avg_score', 'worst_score', 'best_weights', 'diversity']
+
+
+def save_checkpoint(path, ga, history, generation):
+    """
+    Saves everything needed to continue training after generation: the population's weights and
+    piece sequence seeds, the history and the state of both random number generators.
+    The file is written next to the old one and then moved over it, so a crash never leaves a broken checkpoint.
+    """
+    seeds = np.array([agent_seeds if agent_seeds is not None else [-1] * GAMES_PER_AGENT for agent_seeds in ga.seeds],
+                     dtype=np.int64)
+    python_version, python_state, python_gauss = random.getstate()
+    _, numpy_keys, numpy_pos, numpy_has_gauss, numpy_gauss = np.random.get_state()
+
+    arrays = {field: np.array([h[field] for h in history]) for field in HISTORY_FIELDS}
+    arrays.update(
+        generations_run=np.array(generation),
+        population=np.array([agent.weights for agent in ga.population]),
+        seeds=seeds,
+        python_rng_version=np.array(python_version),
+        python_rng_state=np.array(python_state, dtype=np.uint32),
+        python_rng_gauss=np.array(np.nan if python_gauss is None else python_gauss),
+        numpy_rng_keys=numpy_keys,
+        numpy_rng_pos=np.array([numpy_pos, numpy_has_gauss]),
+        numpy_rng_gauss=np.array(numpy_gauss),
+    )
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path, ga):
+    """
+    Restores the population and random number generators saved by save_checkpoint into ga.
+    Returns the history and the number of generations already run.
+    """
+    with np.load(path) as checkpoint:
+        ga.population = [TetrisAgent(weights=weights) for weights in checkpoint['population']]
+        ga.seeds = [None if agent_seeds[0] < 0 else [int(seed) for seed in agent_seeds]
+                    for agent_seeds in checkpoint['seeds']]
+
+        gauss = float(checkpoint['python_rng_gauss'])
+        random.setstate((int(checkpoint['python_rng_version']),
+                         tuple(int(value) for value in checkpoint['python_rng_state']),
+                         None if np.isnan(gauss) else gauss))
+        numpy_pos, numpy_has_gauss = checkpoint['numpy_rng_pos']
+        np.random.set_state(('MT19937', checkpoint['numpy_rng_keys'], int(numpy_pos), int(numpy_has_gauss),
+                             float(checkpoint['numpy_rng_gauss'])))
+
+        return history_from_arrays(checkpoint), int(checkpoint['generations_run'])
+
+
+def history_from_arrays(arrays):
+    """Turns the per-field history arrays of a checkpoint back into one dictionary per generation."""
+    columns = [arrays[field] for field in HISTORY_FIELDS]
+    return [dict(zip(HISTORY_FIELDS, values)) for values in zip(*columns)]
+
+
+def load_history(path=CHECKPOINT_PATH):
+    """Loads the training history stored in a checkpoint, ready for the plotting functions."""
+    with np.load(path) as checkpoint:
+        return history_from_arrays(checkpoint)
 
 
 WEIGHTS_HISTORY = [
@@ -218,6 +537,7 @@ WEIGHTS_HISTORY = [
 
 def plot_learning_curve(evaluation_history):
     """Generates a plot showing the best, average, and worst scores over generations."""
+    import matplotlib.pyplot as plt
     generations = [d['generation'] for d in evaluation_history]
     best_scores = [d['best_score'] for d in evaluation_history]
     avg_scores = [d['avg_score'] for d in evaluation_history]
@@ -242,6 +562,7 @@ def plot_learning_curve(evaluation_history):
 
 def plot_weight_evolution(evaluation_history):
     """Generates a plot showing how each of the four weights evolved."""
+    import matplotlib.pyplot as plt
     generations = [d['generation'] for d in evaluation_history]
     weights = np.array([d['best_weights'] for d in evaluation_history])
 
@@ -266,22 +587,23 @@ def plot_weight_evolution(evaluation_history):
 def evaluate():
     """Function to evaluate the hardcoded weights and generate plots."""
     evaluation_history = []
+    # Run the agent 10 times with different seeds to get a stable performance measure
+    seeds = [seed * 2 for seed in range(150, 161)]
+
+    # Play the games of every generation in one go so a worker pool can run them all in parallel
+    tasks = [(gen_data['best_weights'], seed) for gen_data in WEIGHTS_HISTORY for seed in seeds]
+    with make_evaluator(EVALUATION_BACKEND, NUM_WORKERS, FITNESS_CACHE_SIZE, FITNESS_CACHE_PATH) as evaluator:
+        all_scores = evaluator.evaluate(tasks)
 
     # Iterate over the hardcoded weights history
-    for gen_data in WEIGHTS_HISTORY:
+    for i, gen_data in enumerate(WEIGHTS_HISTORY):
         generation = gen_data['generation']
         current_weights = gen_data['best_weights']
         print(f'Evaluating Generation {generation} best weights: {current_weights}')
 
-        fitness_scores = []
-        # Run the agent 10 times with different seeds to get a stable performance measure
-        for seed in range(150,161):
-            random.seed(seed*2)  # Use a different seed for each run to test robustness
-            agent = TetrisAgent(weights=current_weights)
-            # Run the game in training mode (no visuals, max speed)
-            score = run_tetris_game(agent=agent, is_training=True)
-            fitness_scores.append(score)
-            print(f"    Gen {generation}, Run {seed + 1}/10 -> Score: {score}")
+        fitness_scores = all_scores[i * len(seeds):(i + 1) * len(seeds)]
+        for run, score in enumerate(fitness_scores):
+            print(f"    Gen {generation}, Run {run + 1}/{len(seeds)} -> Score: {score}")
 
         # Calculate metrics from the 10 runs
         best_score = np.max(fitness_scores)
@@ -0,0 +1,83 @@
+"""
+Low-overhead timing of the phases of a game.
+
+Code that supports instrumentation takes an optional PhaseTimer and only
+touches it when one is given, so uninstrumented runs pay one `is None` check
+per phase.
+"""
+import cProfile
+import io
+import pstats
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+clock = time.perf_counter
+
+
+class PhaseTimer:
+    def __init__(self, profile=False):
+        """
+        Args:
+            profile: Also run the instrumented code under cProfile.
+        """
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.profiler = cProfile.Profile() if profile else None
+
+    def start(self):
+        return clock()
+
+    def add(self, phase, start):
+        """Adds the time since start, a value returned by start(), to phase and counts one call of it."""
+        self.seconds[phase] += clock() - start
+        self.counts[phase] += 1
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    @contextmanager
+    def profiling(self):
+        """Runs the block under cProfile if profiling is enabled."""
+        if self.profiler is None:
+            yield
+        else:
+            self.profiler.enable()
+            try:
+                yield
+            finally:
+                self.profiler.disable()
+
+    def report(self):
+        """Cumulative seconds and counts of every phase as plain dictionaries."""
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+    def merge(self, report):
+        """Adds the numbers of another timer's report to this one."""
+        for phase, seconds in report['seconds'].items():
+            self.seconds[phase] += seconds
+        for name, count in report['counts'].items():
+            self.counts[name] += count
+
+    def reset(self):
+        self.seconds.clear()
+        self.counts.clear()
+
+    def profile_stats(self, sort='cumulative', limit=25):
+        """Text of the cProfile statistics, or an empty string when not profiling."""
+        if self.profiler is None:
+            return ''
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def summary(self):
+        """One line per phase with its total time, number of calls and share of the total."""
+        total = sum(self.seconds.values()) or 1.0
+        lines = []
+        for phase, seconds in sorted(self.seconds.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"{phase:20s} {seconds:10.4f}s {self.counts[phase]:10d} calls {seconds / total:7.1%}")
+        for name, count in sorted(self.counts.items()):
+            if name not in self.seconds:
+                lines.append(f"{name:20s} {count:10d}")
+        return '\n'.join(lines)
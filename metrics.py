@@ -0,0 +1,129 @@
+"""
+Structured log of training events.
+
+Records are plain dictionaries with an 'event' field ('run', 'game' or
+'generation'), written one JSON object per line. Every training run starts
+with a 'run' record, so the runs appended to one log can be told apart. Writing happens on a
+background thread, so the code producing the records only pays for putting
+them on a queue.
+"""
+import json
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+
+
+class MetricsLog:
+    def __init__(self, path, buffer_size=1 << 16, resume=False):
+        """
+        Args:
+            path: JSONL file the records are appended to.
+            buffer_size: Bytes buffered before they are written out. The buffer is also
+                flushed whenever the writer has caught up with the queue.
+            resume: The run continues the last run of the log, e.g. from a checkpoint.
+        """
+        self.path = path
+        self.file = open(path, 'a', buffering=buffer_size)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.write(run_record(resume))
+
+    def write(self, record):
+        """Queues a record to be written."""
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.file.write(json.dumps(record) + '\n')
+            if self.queue.empty():
+                self.file.flush()
+        self.file.flush()
+
+    def close(self):
+        """Writes the remaining records and closes the file."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_record(resume=False):
+    """Record that starts a training run, or continues the last one if resume is set."""
+    return {'event': 'run', 'run': uuid.uuid4().hex, 'resume': resume, 'time': time.time()}
+
+
+def game_record(weights, seed, stats, max_pieces=None):
+    """Record of one game from the stats play_game collects."""
+    return {
+        'event': 'game',
+        'weights': [float(w) for w in weights],
+        'seed': int(seed),
+        'max_pieces': max_pieces,
+        'score': stats['score'],
+        'lines': stats['lines'],
+        'pieces': stats['pieces'],
+        'seconds': stats['seconds'],
+        'timings': stats['timings'],
+    }
+
+
+def generation_record(entry, fitness=None, seconds=None, timings=None):
+    """Record of one generation from its training history entry."""
+    return {
+        'event': 'generation',
+        'generation': int(entry['generation']),
+        'best_score': float(entry['best_score']),
+        'avg_score': float(entry['avg_score']),
+        'worst_score': float(entry['worst_score']),
+        'best_weights': [float(w) for w in entry['best_weights']],
+        'diversity': [float(d) for d in entry['diversity']],
+        'fitness': fitness,
+        'seconds': seconds,
+        'timings': timings,
+    }
+
+
+def read_metrics(path, event=None):
+    """Yields the records of a metrics log, only those of the given event if one is given."""
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if event is None or record['event'] == event:
+                yield record
+
+
+def history_from_metrics(path):
+    """
+    Training history of the last run of a metrics log, rebuilt from its generation records in the
+    format the plotting functions take. Resumed runs count as part of the run they continue, and a
+    generation logged more than once by them keeps its last record.
+    """
+    generations = {}
+    for record in read_metrics(path):
+        if record['event'] == 'run' and not record['resume']:
+            generations = {}
+        if record['event'] != 'generation':
+            continue
+        generations[record['generation']] = {
+            'generation': record['generation'],
+            'best_score': record['best_score'],
+            'avg_score': record['avg_score'],
+            'worst_score': record['worst_score'],
+            'best_weights': np.array(record['best_weights']),
+            'diversity': np.array(record['diversity']),
+        }
+    return [generations[generation] for generation in sorted(generations)]
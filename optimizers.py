@@ -0,0 +1,145 @@
+"""
+Ask/tell optimizers for the agent weights.
+
+An optimizer proposes candidate weight vectors with ask() and learns from
+their fitness with tell(). Fitness comes from any evaluator of
+evaluation.py, so the same optimizer runs on the sequential, pool or batched
+backend.
+"""
+import random
+import time
+import numpy as np
+from evaluation import ranking_keys
+from metrics import generation_record
+
+
+class CMAES:
+    """
+    Covariance matrix adaptation evolution strategy, maximizing fitness.
+
+    Candidates are drawn from a normal distribution around the mean. After
+    every generation the mean moves towards the best candidates and the
+    covariance matrix and step size adapt to the directions and distances
+    that paid off, so a small weight vector is found with few games.
+    Only the ranking of the fitness values matters, not their scale.
+    """
+    def __init__(self, mean, sigma=0.3, population_size=None, rng=None):
+        """
+        Args:
+            mean: Starting point of the search.
+            sigma: Starting step size, about a quarter of the range the weights are expected in.
+            population_size: Candidates per generation, 4 + 3 ln(n) by default.
+            rng: numpy Generator the candidates are drawn with.
+        """
+        self.mean = np.array(mean, dtype=float)
+        self.sigma = sigma
+        n = len(self.mean)
+        self.population_size = population_size or 4 + int(3 * np.log(n))
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        # recombination weights of the best half
+        self.mu = self.population_size // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mu_eff = 1 / np.sum(self.weights ** 2)
+
+        # learning rates of the evolution paths, the covariance matrix and the step size
+        self.c_c = (4 + self.mu_eff / n) / (n + 4 + 2 * self.mu_eff / n)
+        self.c_sigma = (self.mu_eff + 2) / (n + self.mu_eff + 5)
+        self.c_1 = 2 / ((n + 1.3) ** 2 + self.mu_eff)
+        self.c_mu = min(1 - self.c_1, 2 * (self.mu_eff - 2 + 1 / self.mu_eff) / ((n + 2) ** 2 + self.mu_eff))
+        self.d_sigma = 1 + 2 * max(0, np.sqrt((self.mu_eff - 1) / (n + 1)) - 1) + self.c_sigma
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))  # expected length of a standard normal vector
+
+        self.p_c = np.zeros(n)
+        self.p_sigma = np.zeros(n)
+        self.C = np.eye(n)
+        self.B = np.eye(n)  # eigenvectors of C
+        self.D = np.ones(n)  # square roots of the eigenvalues of C
+        self.generation = 0
+
+        self.best_solution = None
+        self.best_fitness = -np.inf
+
+    def ask(self):
+        """Candidates of the next generation, one per row."""
+        z = self.rng.standard_normal((self.population_size, len(self.mean)))
+        return self.mean + self.sigma * (z * self.D) @ self.B.T
+
+    def tell(self, solutions, fitness, ranking=None):
+        """
+        Updates the distribution with the fitness of every candidate, higher is better.
+        With ranking, a sort key per candidate, candidates are ranked by it instead of their fitness.
+        """
+        solutions = np.asarray(solutions, dtype=float)
+        fitness = np.asarray(fitness, dtype=float)
+        if ranking is None:
+            order = np.argsort(-fitness, kind='stable')
+        else:
+            order = np.array(sorted(range(len(fitness)), key=lambda i: ranking[i], reverse=True))
+        if fitness[order[0]] > self.best_fitness:
+            self.best_fitness = fitness[order[0]]
+            self.best_solution = solutions[order[0]].copy()
+
+        n = len(self.mean)
+        y = (solutions[order[:self.mu]] - self.mean) / self.sigma
+        y_w = self.weights @ y
+        self.mean = self.mean + self.sigma * y_w
+
+        # evolution paths, the step size path is measured in the coordinates of C
+        inverse_sqrt_c = self.B @ np.diag(1 / self.D) @ self.B.T
+        self.p_sigma = ((1 - self.c_sigma) * self.p_sigma +
+                        np.sqrt(self.c_sigma * (2 - self.c_sigma) * self.mu_eff) * inverse_sqrt_c @ y_w)
+        p_sigma_norm = np.linalg.norm(self.p_sigma)
+        stalled = p_sigma_norm / np.sqrt(1 - (1 - self.c_sigma) ** (2 * (self.generation + 1)))
+        h_sigma = 1.0 if stalled < (1.4 + 2 / (n + 1)) * self.chi_n else 0.0
+        self.p_c = (1 - self.c_c) * self.p_c + h_sigma * np.sqrt(self.c_c * (2 - self.c_c) * self.mu_eff) * y_w
+
+        # rank-one update from the path and rank-mu update from the best candidates
+        rank_one = np.outer(self.p_c, self.p_c) + (1 - h_sigma) * self.c_c * (2 - self.c_c) * self.C
+        rank_mu = (self.weights[:, None] * y).T @ y
+        self.C = (1 - self.c_1 - self.c_mu) * self.C + self.c_1 * rank_one + self.c_mu * rank_mu
+        self.sigma *= np.exp(self.c_sigma / self.d_sigma * (p_sigma_norm / self.chi_n - 1))
+
+        self.C = (self.C + self.C.T) / 2
+        eigenvalues, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        self.generation += 1
+
+
+def optimize(optimizer, evaluator, generations, games=1, max_pieces=None, metrics=None):
+    """
+    Runs an ask/tell optimizer for a number of generations. Every candidate of a
+    generation plays the same games piece sequences, so they are compared on
+    equal terms, and its fitness is its average score.
+    Returns the history of every generation in the format of the GA's history.
+    """
+    history = []
+    total_games = 0
+    for generation in range(generations):
+        start = time.perf_counter()
+        candidates = optimizer.ask()
+        seeds = [random.randrange(2**32) for _ in range(games)]
+        tasks = [(weights, seed, max_pieces) for weights in candidates for seed in seeds]
+        scores = evaluator.evaluate(tasks)
+        fitness = np.array(scores, dtype=float).reshape(len(candidates), games).mean(axis=1)
+        optimizer.tell(candidates, fitness, ranking_keys(evaluator, fitness.tolist(), games))
+        total_games += len(tasks)
+
+        best = int(np.argmax(fitness))
+        history.append({
+            'generation': generation + 1,
+            'best_score': fitness[best],
+            'avg_score': fitness.mean(),
+            'worst_score': fitness.min(),
+            'best_weights': candidates[best],
+            'diversity': np.std(candidates, axis=0),
+            'games': total_games,
+        })
+        seconds = time.perf_counter() - start
+        if metrics is not None:
+            metrics.write(generation_record(history[-1], fitness.tolist(), seconds))
+        print(f"Generation {generation + 1}/{generations}: best {fitness[best]}, avg {fitness.mean():.2f}, "
+              f"mean weights {optimizer.mean} ({total_games} games, {seconds:.1f}s)")
+
+    return history
@@ -0,0 +1,98 @@
+"""
+Placements a piece can reach with the moves of Tetris.main.
+
+The agent's usual move generator only drops pieces straight down from the
+top. This one searches breadth-first over (x, y, rotation) with the moves the
+game loop supports: one column left or right, one rotation step and one row
+down, each only if the piece still fits. It finds every position the piece can
+lock in, including slides and tucks under overhangs, and the inputs that get
+it there.
+
+The search skips the empty rows above the stack: as long as a piece is fully
+above the highest filled cell every rotation, column and row is free, so the
+search starts from every rotation and column just above the stack.
+"""
+from collections import deque
+
+LEFT = 'left'
+RIGHT = 'right'
+ROTATE = 'rotate'
+DOWN = 'down'
+
+
+def reachable_placements(piece, board):
+    """
+    Every distinct position the piece can lock in from where it is now, fully inside the board.
+    Returns a list of moves {'rotation', 'x', 'y', 'path'}, ordered by rotation, column and row,
+    where path is the list of inputs from the piece's current position, shortest first found.
+    """
+    orientations = piece.orientations
+    count = len(orientations)
+    fits = board.fits
+    start = (piece.x, piece.y, piece.rotation % count)
+
+    # columns every rotation can take without leaving the board
+    x_ranges = [(-o.min_x, board.width - 1 - o.max_x) for o in orientations]
+    sky = min(board.column_tops())
+    start_x, start_y, start_rotation = start
+
+    parents = {}
+    queue = deque()
+    if all(low <= start_x <= high and start_y + o.max_y < sky for o, (low, high) in zip(orientations, x_ranges)):
+        # rotate at the start, slide along the top and drop to the lowest row above the stack
+        for steps in range(count):
+            rotation = (start_rotation + steps) % count
+            low, high = x_ranges[rotation]
+            y = sky - 1 - orientations[rotation].max_y
+            for x in range(low, high + 1):
+                state = (x, y, rotation)
+                side = [LEFT] * (start_x - x) if x < start_x else [RIGHT] * (x - start_x)
+                parents[state] = (None, [ROTATE] * steps + side + [DOWN] * (y - start_y))
+                queue.append(state)
+    elif fits(orientations[start_rotation].masks, start_x - 2, start_y - 4):
+        parents[start] = (None, [])
+        queue.append(start)
+
+    # breadth-first search below the top of the stack
+    locks = []
+    while queue:
+        state = queue.popleft()
+        x, y, rotation = state
+        for move, neighbour in ((LEFT, (x - 1, y, rotation)), (RIGHT, (x + 1, y, rotation)),
+                                (ROTATE, (x, y, (rotation + 1) % count)), (DOWN, (x, y + 1, rotation))):
+            if neighbour in parents:
+                continue
+            nx, ny, nrotation = neighbour
+            low, high = x_ranges[nrotation]
+            if low <= nx <= high and fits(orientations[nrotation].masks, nx - 2, ny - 4):
+                parents[neighbour] = (state, move)
+                queue.append(neighbour)
+            elif move == DOWN:
+                locks.append(state)
+
+    # the same cells can be reached with different rotations, keep the first one found
+    placements = {}
+    for x, y, rotation in locks:
+        orientation = orientations[rotation]
+        if y + orientation.min_y < 0:
+            continue
+        cells = frozenset((x + cx, y + cy) for cx, cy in orientation.cells)
+        if cells not in placements:
+            placements[cells] = (rotation, x, y)
+
+    moves = []
+    for rotation, x, y in sorted(placements.values()):
+        moves.append({'rotation': rotation, 'x': x, 'y': y, 'path': input_path(parents, (x, y, rotation))})
+    return moves
+
+
+def input_path(parents, state):
+    """Inputs that lead to state, following the parents of the search back to where it started."""
+    path = []
+    parent, move = parents[state]
+    while parent is not None:
+        path.append(move)
+        state = parent
+        parent, move = parents[state]
+    path.reverse()
+    return move + path
@@ -0,0 +1,312 @@
+"""
+Compact recordings of games.
+
+A replay stores the seed of the piece sequence and every placement as it was
+locked: the shape, rotation and position of the piece, packed into two bytes.
+Playing a replay back only locks the recorded placements and clears lines, so
+it rebuilds the game exactly without running the agent.
+
+Saved replays also hold a keyframe of the game every few thousand
+placements, so any point of a long game can be reached by restoring the
+keyframe before it and playing back only the placements after that.
+
+File layout, little-endian:
+
+    header      magic b'TRPL', version, flags, board width, board height,
+                seed (int64), final score (int64), number of placements (uint32),
+                keyframe interval (uint32), number of keyframes (uint32)
+    placements  one uint16 per placement: shape (3 bits), rotation (2 bits),
+                x + 2 (4 bits), y + 8 (7 bits), from the lowest bit up
+    keyframes   the game after every keyframe interval placements, all of the same size:
+                placements, score (int64), lines, level (uint32), one uint16 row mask per row,
+                the shapes left in the 7-bag (count and up to 7 shape indices, one byte each)
+                and, if there is a seed, the 625 words of the bag's random generator state
+
+Version 1 files have no keyframe fields and no keyframes.
+"""
+import random
+import struct
+import sys
+from array import array
+from board import Board
+from rules import Piece, PieceBag, col, row, shapes, shape_table, line_clear_score
+
+MAGIC = b'TRPL'
+VERSION = 2
+HEADER_V1 = struct.Struct('<4sBBBBqqI')
+HEADER = struct.Struct('<4sBBBBqqIII')
+KEYFRAME = struct.Struct('<IqII')
+HAS_SEED = 1
+HAS_SCORE = 2
+KEYFRAME_INTERVAL = 4096  # placements between keyframes
+RNG_STATE_WORDS = 625
+
+
+def keyframe_size(height, has_seed):
+    return KEYFRAME.size + 2 * height + 8 + (4 * RNG_STATE_WORDS if has_seed else 0)
+
+
+def to_little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_little_endian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def encode_placement(shape, rotation, x, y):
+    """Packs a locked piece into 16 bits."""
+    if not (0 <= shape < 8 and 0 <= rotation < 4 and -2 <= x < 14 and -8 <= y < 120):
+        raise ValueError(f"Placement out of range: shape {shape}, rotation {rotation}, x {x}, y {y}")
+    return shape | rotation << 3 | (x + 2) << 5 | (y + 8) << 9
+
+
+def decode_placement(value):
+    """Unpacks (shape, rotation, x, y) from 16 bits."""
+    return value & 7, value >> 3 & 3, (value >> 5 & 15) - 2, (value >> 9) - 8
+
+
+class ReplayRecorder:
+    """Collects the placements of a game, pass one to Tetris.main to record it."""
+    def __init__(self):
+        self.seed = None
+        self.score = None
+        self.placements = array('H')
+
+    def start(self, seed):
+        self.seed = seed
+        self.score = None
+        self.placements = array('H')
+
+    def record(self, piece):
+        """Records a piece as it is locked."""
+        rotation = piece.rotation % len(piece.orientations)
+        self.placements.append(encode_placement(piece.index, rotation, piece.x, piece.y))
+
+    def finish(self, score):
+        self.score = score
+
+    def replay(self):
+        return Replay(self.seed, list(self.placements), self.score)
+
+    def save(self, path):
+        self.replay().save(path)
+
+
+class Replay:
+    def __init__(self, seed, placements, score=None, width=col, height=row, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        Args:
+            seed: Seed of the piece sequence, None if the pieces came from elsewhere.
+            placements: Packed placements in the order they were locked.
+            score: Final score of the recorded game, None if the game didn't finish.
+            keyframe_interval: Placements between the keyframes stored with the replay, 0 for none.
+        """
+        self.seed = seed
+        self.placements = placements
+        self.score = score
+        self.width = width
+        self.height = height
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = None  # packed keyframes, built when they are first needed
+
+    def build_keyframes(self):
+        """Plays the replay back once and packs the game after every keyframe_interval placements."""
+        keyframes = []
+        if self.keyframe_interval > 0:
+            last = len(self.placements) - len(self.placements) % self.keyframe_interval
+            game = ReplayGame(self.seed, self.width, self.height)
+            for index in range(last):
+                game.apply(*decode_placement(self.placements[index]))
+                if (index + 1) % self.keyframe_interval == 0:
+                    keyframes.append(game.snapshot())
+        self.keyframes = keyframes
+
+    def to_bytes(self):
+        if self.keyframes is None:
+            self.build_keyframes()
+        flags = (HAS_SEED if self.seed is not None else 0) | (HAS_SCORE if self.score is not None else 0)
+        header = HEADER.pack(MAGIC, VERSION, flags, self.width, self.height,
+                             self.seed if self.seed is not None else 0,
+                             self.score if self.score is not None else 0, len(self.placements),
+                             self.keyframe_interval, len(self.keyframes))
+        return header + to_little_endian(array('H', self.placements)) + b''.join(self.keyframes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        replay, offset = cls.read_header(data)
+        count = len(replay.placements)
+        replay.placements = list(from_little_endian('H', data[offset:offset + 2 * count]))
+        if len(replay.placements) != count:
+            raise ValueError("Replay is truncated")
+        if replay.keyframes is not None:
+            size = keyframe_size(replay.height, replay.seed is not None)
+            start = offset + 2 * count
+            replay.keyframes = [data[start + i * size:start + (i + 1) * size] for i in range(len(replay.keyframes))]
+        return replay
+
+    @classmethod
+    def read_header(cls, data):
+        """
+        Replay with the fields of a header, with placeholder lists of the right length for the
+        placements and keyframes. Returns it and the offset of the placements.
+        """
+        magic, version = struct.unpack_from('<4sB', data)
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError("Not a replay of a known version")
+        if version == 1:
+            _, _, flags, width, height, seed, score, count = HEADER_V1.unpack_from(data)
+            interval, num_keyframes, offset = 0, 0, HEADER_V1.size
+        else:
+            _, _, flags, width, height, seed, score, count, interval, num_keyframes = HEADER.unpack_from(data)
+            offset = HEADER.size
+        replay = cls(seed if flags & HAS_SEED else None, [None] * count,
+                     score if flags & HAS_SCORE else None, width, height, interval)
+        replay.keyframes = [None] * num_keyframes
+        return replay, offset
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    def play(self, start=None):
+        """
+        Plays the placements back one after another. Yields the game after each one.
+        With a start game, e.g. one restored from a keyframe, play continues from it.
+        """
+        game = start if start is not None else ReplayGame(self.seed, self.width, self.height)
+        for index in range(game.pieces, len(self.placements)):
+            game.apply(*decode_placement(self.placements[index]))
+            yield game
+
+    def game_at(self, pieces):
+        """The game after the given number of placements, played back from the nearest keyframe."""
+        if not 0 <= pieces <= len(self.placements):
+            raise IndexError(f"The replay has {len(self.placements)} placements")
+        if self.keyframes is None:
+            self.build_keyframes()
+
+        game = ReplayGame(self.seed, self.width, self.height)
+        keyframe = min(pieces // self.keyframe_interval if self.keyframe_interval else 0, len(self.keyframes))
+        if keyframe > 0:
+            game = ReplayGame.from_snapshot(self.keyframes[keyframe - 1], self.seed, self.width, self.height)
+        for index in range(game.pieces, pieces):
+            game.apply(*decode_placement(self.placements[index]))
+        return game
+
+
+def seek(path, pieces):
+    """
+    The game of a replay file after the given number of placements. Only the header,
+    the nearest keyframe before that point and the placements after it are read.
+    """
+    with open(path, 'rb') as f:
+        replay, offset = Replay.read_header(f.read(HEADER.size))
+        count = len(replay.placements)
+        if not 0 <= pieces <= count:
+            raise IndexError(f"The replay has {count} placements")
+
+        game = ReplayGame(replay.seed, replay.width, replay.height)
+        keyframe = min(pieces // replay.keyframe_interval if replay.keyframe_interval else 0, len(replay.keyframes))
+        if keyframe > 0:
+            size = keyframe_size(replay.height, replay.seed is not None)
+            f.seek(offset + 2 * count + (keyframe - 1) * size)
+            game = ReplayGame.from_snapshot(f.read(size), replay.seed, replay.width, replay.height)
+
+        f.seek(offset + 2 * game.pieces)
+        for value in from_little_endian('H', f.read(2 * (pieces - game.pieces))):
+            game.apply(*decode_placement(value))
+        return game
+
+
+class ReplayGame:
+    """Game state rebuilt from placements, following the rules of Tetris.main."""
+    def __init__(self, seed=None, width=col, height=row):
+        self.board = Board(width, height)
+        self.board.colors = None
+        self.score = 0
+        self.lines = 0
+        self.level = 1
+        self.pieces = 0
+        # the piece sequence of the seed, to check the recorded pieces against
+        self.bag = PieceBag(random.Random(seed)) if seed is not None else None
+
+    def apply(self, shape, rotation, x, y):
+        """Locks a piece, clears lines and updates the score."""
+        if self.bag is not None:
+            expected = self.bag.get_shape().index
+            if shape != expected:
+                raise ValueError(f"Piece {self.pieces} is shape {shape}, the seed deals shape {expected}")
+
+        self.board.place(shape_table[shape][rotation].masks, x - 2, y - 4)
+        lines_cleared = self.board.clear_full_rows()
+        if lines_cleared > 0:
+            self.lines += lines_cleared
+            self.score += line_clear_score(lines_cleared, self.level)
+            if self.lines >= self.level * 10:
+                self.level += 1
+        self.pieces += 1
+
+    @property
+    def lost(self):
+        return self.board.rows[0] != 0
+
+    def snapshot(self):
+        """Packs the game into a keyframe."""
+        bag = [piece.index for piece in self.bag.pieces] if self.bag is not None else []
+        data = [KEYFRAME.pack(self.pieces, self.score, self.lines, self.level),
+                to_little_endian(array('H', self.board.rows)),
+                bytes([len(bag)] + bag + [0] * (7 - len(bag)))]
+        if self.bag is not None:
+            version, state, gauss = self.bag.rng.getstate()
+            data.append(to_little_endian(array('I', state)))
+        return b''.join(data)
+
+    @classmethod
+    def from_snapshot(cls, data, seed=None, width=col, height=row):
+        """Restores a game from a keyframe made by snapshot."""
+        game = cls(seed, width, height)
+        game.pieces, game.score, game.lines, game.level = KEYFRAME.unpack_from(data)
+        offset = KEYFRAME.size
+        game.board.set_rows(from_little_endian('H', data[offset:offset + 2 * height]))
+        offset += 2 * height
+        if game.bag is not None:
+            count = data[offset]
+            game.bag.pieces = [Piece(5, 0, shapes[index]) for index in data[offset + 1:offset + 1 + count]]
+            state = from_little_endian('I', data[offset + 8:offset + 8 + 4 * RNG_STATE_WORDS])
+            game.bag.rng.setstate((3, tuple(state), None))
+        return game
+
+
+def replay_game(replay):
+    """Plays a replay back to the end and returns the final game."""
+    game = ReplayGame(replay.seed, replay.width, replay.height)
+    for game in replay.play():
+        pass
+    return game
+
+
+def verify(replay):
+    """Checks that playing the replay back gives the recorded score. Returns the final game."""
+    game = replay_game(replay)
+    if replay.score is not None and game.score != replay.score:
+        raise ValueError(f"Replay scores {game.score}, the recording says {replay.score}")
+    return game
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        game = verify(Replay.load(path))
+        print(f"{path}: {game.pieces} pieces, {game.lines} lines, level {game.level}, score {game.score}")
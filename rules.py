@@ -0,0 +1,257 @@
+"""
+Rules of the game without any drawing: the shapes and their rotations,
+pieces and the 7-bag they are dealt from, collision, locking, line clears and
+scoring. Imports nothing but the standard library and the board, so headless
+games and training workers never load pygame.
+
+10 x 20 grid
+play_height = 2 * play_width
+
+tetriminos:
+    0 - S - green
+    1 - Z - red
+    2 - I - cyan
+    3 - O - yellow
+    4 - J - blue
+    5 - L - orange
+    6 - T - purple
+"""
+import random
+
+col = 10  # 10 columns
+row = 20  # 20 rows
+
+# points for clearing 1, 2, 3 or 4 lines at once, multiplied by the level
+SCORE_MULTIPLIERS = {1: 40, 2: 100, 3: 300, 4: 1200}
+
+# shapes formats
+
+S = [['.....',
+      '.....',
+      '..00.',
+      '.00..',
+      '.....'],
+     ['.....',
+      '..0..',
+      '..00.',
+      '...0.',
+      '.....']]
+
+Z = [['.....',
+      '.....',
+      '.00..',
+      '..00.',
+      '.....'],
+     ['.....',
+      '..0..',
+      '.00..',
+      '.0...',
+      '.....']]
+
+I = [['.....',
+      '..0..',
+      '..0..',
+      '..0..',
+      '..0..'],
+     ['.....',
+      '0000.',
+      '.....',
+      '.....',
+      '.....']]
+
+O = [['.....',
+      '.....',
+      '.00..',
+      '.00..',
+      '.....']]
+
+J = [['.....',
+      '.0...',
+      '.000.',
+      '.....',
+      '.....'],
+     ['.....',
+      '..00.',
+      '..0..',
+      '..0..',
+      '.....'],
+     ['.....',
+      '.....',
+      '.000.',
+      '...0.',
+      '.....'],
+     ['.....',
+      '..0..',
+      '..0..',
+      '.00..',
+      '.....']]
+
+L = [['.....',
+      '...0.',
+      '.000.',
+      '.....',
+      '.....'],
+     ['.....',
+      '..0..',
+      '..0..',
+      '..00.',
+      '.....'],
+     ['.....',
+      '.....',
+      '.000.',
+      '.0...',
+      '.....'],
+     ['.....',
+      '.00..',
+      '..0..',
+      '..0..',
+      '.....']]
+
+T = [['.....',
+      '..0..',
+      '.000.',
+      '.....',
+      '.....'],
+     ['.....',
+      '..0..',
+      '..00.',
+      '..0..',
+      '.....'],
+     ['.....',
+      '.....',
+      '.000.',
+      '..0..',
+      '.....'],
+     ['.....',
+      '..0..',
+      '.00..',
+      '..0..',
+      '.....']]
+
+# index represents the shape
+shapes = [S, Z, I, O, J, L, T]
+shape_colors = [(0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 255, 0), (255, 165, 0), (0, 0, 255), (128, 0, 128)]
+
+
+# precomputed data for a single rotation of a shape
+class Orientation(object):
+    def __init__(self, shape_format):
+        # cell offsets from the piece position, with the -2/-4 shape format offset applied
+        self.cells = []
+        for i, line in enumerate(shape_format):
+            for j, column in enumerate(line):
+                if column == '0':
+                    self.cells.append((j - 2, i - 4))
+
+        # bounding box of the cell offsets
+        self.min_x = min(x for x, y in self.cells)
+        self.max_x = max(x for x, y in self.cells)
+        self.min_y = min(y for x, y in self.cells)
+        self.max_y = max(y for x, y in self.cells)
+        self.width = self.max_x - self.min_x + 1
+        self.height = self.max_y - self.min_y + 1
+
+        # lowest cell offset of every column the shape covers, as (x, y) pairs
+        self.bottom = [(x, max(cy for cx, cy in self.cells if cx == x))
+                       for x in range(self.min_x, self.max_x + 1)]
+
+        # (x, highest cell offset, number of cells) of every column the shape covers
+        self.columns = [(x, min(cy for cx, cy in self.cells if cx == x), sum(1 for cx, cy in self.cells if cx == x))
+                        for x in range(self.min_x, self.max_x + 1)]
+
+        # (y, number of cells) of every row the shape covers
+        self.row_counts = [(y, sum(1 for cx, cy in self.cells if cy == y)) for y in range(self.min_y, self.max_y + 1)]
+
+        # row masks as (row, bits) pairs, bit j set when column j of the shape format is filled;
+        # they sit on the board at (piece.x - 2, piece.y - 4)
+        self.masks = []
+        for i, line in enumerate(shape_format):
+            bits = 0
+            for j, column in enumerate(line):
+                if column == '0':
+                    bits |= 1 << j
+            if bits:
+                self.masks.append((i, bits))
+
+
+# shape_table[shape index][rotation], built once at import
+shape_table = [[Orientation(shape_format) for shape_format in shape] for shape in shapes]
+
+
+# class to represent each of the pieces
+class Piece(object):
+    def __init__(self, x, y, shape):
+        self.x = x
+        self.y = y
+        self.shape = shape
+        self.index = shapes.index(shape)
+        self.color = shape_colors[self.index]
+        self.rotation = 0
+
+    @property
+    def orientations(self):
+        return shape_table[self.index]
+
+    @property
+    def orientation(self):
+        return shape_table[self.index][self.rotation % len(self.shape)]
+
+
+class PieceBag:
+    def __init__(self, rng=None):
+        # any object with a shuffle method, e.g. random.Random; defaults to the global random module
+        self.rng = rng if rng is not None else random
+        self.pieces = []
+
+    def get_shape(self):
+        if not self.pieces:
+            bag = list(shapes)
+            self.rng.shuffle(bag)
+            pieces = []
+            for shape in bag:
+                pieces.append(Piece(5, 0, shape))
+            self.pieces = pieces
+        return self.pieces.pop()
+
+
+def create_grid(board=None):
+    """Color grid of the board, used for drawing."""
+    if board is None:
+        return [[(0, 0, 0) for x in range(col)] for y in range(row)]
+    return [line[:] for line in board.colors]
+
+
+def convert_shape_format(piece):
+    return [(piece.x + x, piece.y + y) for x, y in piece.orientation.cells]
+
+
+def valid_space(piece, board):
+    return board.fits(piece.orientation.masks, piece.x - 2, piece.y - 4)
+
+
+def lock_piece(piece, board):
+    board.place(piece.orientation.masks, piece.x - 2, piece.y - 4, piece.color)
+
+
+def check_lost(board):
+    return board.rows[0] != 0
+
+
+def clear_rows(board):
+    """
+    Checks for completed rows, clears them, and shifts the rows above down.
+    Returns the number of rows cleared.
+    """
+    return board.clear_full_rows()
+
+def line_clear_score(lines_cleared, level):
+    """Points for clearing lines_cleared lines at once at the given level."""
+    return SCORE_MULTIPLIERS.get(lines_cleared, 0) * level
+
+
+def get_game_state(current_piece, next_piece, board):
+    return {
+        'current_piece': current_piece,
+        'next_piece': next_piece,
+        'board': board
+    }
@@ -0,0 +1,120 @@
+"""
+Lockstep games spread over several worker processes.
+
+A large batch of games is split into shards, one per worker, and every
+worker plays its shard with a VectorTetris. The weights, seeds, piece budgets
+and the whole game state of the batch live in one block of shared memory:
+workers attach to it once, step their games directly in it and leave the
+scores there, so only the name of the block and the shard numbers are sent
+to them. Shard s holds the games s, s + shards, s + 2 * shards, ..., so the
+games of one agent and long and short games spread evenly over the shards.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from instrumentation import PhaseTimer
+from rules import col, row
+from vector_env import NO_BUDGET, VectorTetris, state_layout
+
+
+def batch_layout(num_games, rows=row, cols=col):
+    """(name, dtype, shape) of every array of a batch in shared memory: its inputs and then the game state."""
+    return [
+        ('weights', np.float64, (num_games, 4)),
+        ('seeds', np.int64, (num_games,)),
+        ('max_pieces', np.int64, (num_games,)),
+    ] + state_layout(num_games, rows, cols)
+
+
+def attach(memory, num_games, rows=row, cols=col):
+    """Arrays of a batch by name, as views of the shared memory block, each starting at a multiple of 8 bytes."""
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in batch_layout(num_games, rows, cols):
+        array = np.ndarray(shape, dtype, buffer=memory.buf, offset=offset)
+        arrays[name] = array
+        offset += -(-array.nbytes // 8) * 8
+    return arrays
+
+
+def batch_size(num_games, rows=row, cols=col):
+    """Bytes of shared memory a batch takes."""
+    return sum(-(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+               for name, dtype, shape in batch_layout(num_games, rows, cols))
+
+
+def run_shard(memory_name, num_games, shard, shards, time_limit=None, collect_timings=False):
+    """
+    Plays the games of one shard in a worker process, in the shared memory block of the batch.
+    Returns the timer's report if collect_timings is set, otherwise None.
+    """
+    memory = shared_memory.SharedMemory(name=memory_name)
+    try:
+        arrays = attach(memory, num_games)
+        views = {name: array[shard::shards] for name, array in arrays.items()}
+        timer = PhaseTimer() if collect_timings else None
+        game = VectorTetris(views['weights'], [int(seed) for seed in views['seeds']], timer=timer,
+                            max_pieces=views['max_pieces'], state=views)
+        game.run(time_limit)
+        del game, views, arrays
+        return timer.report() if timer is not None else None
+    finally:
+        memory.close()
+
+
+class ShardedRunner:
+    """
+    Plays batches of games on a pool of worker processes, one shard per worker.
+    Workers are spawned once and kept for every batch, like the pool evaluator's.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+
+    def run(self, weights, seeds, max_pieces=None, time_limit=None, timer=None):
+        """
+        Plays one game per (weights, seed) pair and returns the scores, lines and pieces placed of every game.
+        max_pieces is one budget for all games or one per game, None for no budget. The time limit applies to
+        every shard, and the phase timings of all shards are added to timer if one is given.
+        """
+        num_games = len(seeds)
+        if num_games == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+        memory = shared_memory.SharedMemory(create=True, size=batch_size(num_games))
+        try:
+            arrays = attach(memory, num_games)
+            arrays['weights'][...] = weights
+            arrays['seeds'][...] = seeds
+            arrays['max_pieces'][...] = max_pieces if max_pieces is not None else NO_BUDGET
+
+            shards = min(self.workers, num_games)
+            reports = list(self.executor.map(run_shard, [memory.name] * shards, [num_games] * shards,
+                                             range(shards), [shards] * shards, [time_limit] * shards,
+                                             [timer is not None] * shards))
+            if timer is not None:
+                for report in reports:
+                    timer.merge(report)
+
+            results = arrays['scores'].copy(), arrays['lines'].copy(), arrays['pieces_placed'].copy()
+            del arrays
+            return results
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,152 @@
+"""
+Local store of finished games.
+
+Every game is one row of an SQLite table: the mode it was played in
+('human', 'ai' or 'training'), the agent's weights, the seed, score, lines,
+level, pieces placed and duration. New games are kept in memory and written
+together in one transaction, either when the batch is full, when
+flush_interval seconds have passed or when flush is called, e.g. at the end
+of a game. A transaction is all or nothing, so a crash never leaves half a
+batch in the file. Queries flush first, so they always see every game.
+"""
+import math
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    finished REAL NOT NULL,
+    mode TEXT NOT NULL,
+    weights TEXT,
+    seed INTEGER,
+    score INTEGER NOT NULL,
+    lines INTEGER,
+    level INTEGER,
+    pieces INTEGER,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS games_score ON games (score);
+CREATE INDEX IF NOT EXISTS games_mode_score ON games (mode, score);
+CREATE INDEX IF NOT EXISTS games_weights ON games (weights, finished);
+"""
+COLUMNS = ('finished', 'mode', 'weights', 'seed', 'score', 'lines', 'level', 'pieces', 'seconds')
+
+
+def weights_key(weights, decimals=9):
+    """Text the weights are stored and looked up by, rounded so equal agents always match."""
+    if weights is None:
+        return None
+    return ','.join(repr(round(float(w), decimals)) for w in weights)
+
+
+class StatsStore:
+    def __init__(self, path='stats.db', batch_size=100, flush_interval=5.0):
+        """
+        Args:
+            path: SQLite file the games are kept in, ':memory:' for a store that isn't saved.
+            batch_size: Games kept in memory before they are written.
+            flush_interval: Seconds after which kept games are written with the next one added.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(path)
+        if path != ':memory:':
+            # readers in other processes don't block the writer
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def add_game(self, mode, score, weights=None, seed=None, lines=None, level=None, pieces=None, seconds=None):
+        """Adds a finished game, it is written with the next batch."""
+        self.pending.append((time.time(), mode, weights_key(weights), seed, int(score), lines, level, pieces, seconds))
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the kept games in one transaction."""
+        if self.pending:
+            with self.connection:
+                self.connection.executemany(
+                    f"INSERT INTO games ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    self.pending)
+            self.pending = []
+        self.last_flush = time.monotonic()
+
+    def import_highscore(self, path):
+        """Adds the score of a highscore.txt file as an 'import' game, if the file has one."""
+        try:
+            with open(path, 'r') as file:
+                score = int(file.readline().strip())
+        except (FileNotFoundError, ValueError):
+            return
+        self.add_game('import', score)
+        self.flush()
+
+    def count(self, mode=None):
+        self.flush()
+        if mode is None:
+            return self.connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+        return self.connection.execute("SELECT COUNT(*) FROM games WHERE mode = ?", (mode,)).fetchone()[0]
+
+    def highscore(self, mode=None):
+        """Best score of all games, or of the games of one mode. 0 without games."""
+        self.flush()
+        if mode is None:
+            score = self.connection.execute("SELECT MAX(score) FROM games").fetchone()[0]
+        else:
+            score = self.connection.execute("SELECT MAX(score) FROM games WHERE mode = ?", (mode,)).fetchone()[0]
+        return score if score is not None else 0
+
+    def percentiles(self, percents=(50, 90, 99), mode=None):
+        """
+        Nearest-rank percentiles of the scores, one per percent. Each one is read from the score
+        index, so the scores are never loaded. None for every percent without games.
+        """
+        total = self.count(mode)
+        if total == 0:
+            return [None] * len(percents)
+        results = []
+        for percent in percents:
+            offset = min(total - 1, max(0, math.ceil(percent * total / 100) - 1))
+            if mode is None:
+                query = self.connection.execute("SELECT score FROM games ORDER BY score LIMIT 1 OFFSET ?",
+                                                (offset,))
+            else:
+                query = self.connection.execute(
+                    "SELECT score FROM games WHERE mode = ? ORDER BY score LIMIT 1 OFFSET ?", (mode, offset))
+            results.append(query.fetchone()[0])
+        return results
+
+    def history(self, weights):
+        """Every game of the agent with these weights, oldest first, as dictionaries of the columns."""
+        self.flush()
+        rows = self.connection.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM games WHERE weights = ? ORDER BY finished", (weights_key(weights),))
+        return [dict(zip(COLUMNS, values)) for values in rows]
+
+    def close(self):
+        """Writes the kept games and closes the file."""
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_store(path, highscore_path=None):
+    """
+    Opens the store at path. A store that doesn't exist yet starts with the score of
+    highscore_path, so the highscore of the old text file carries over.
+    """
+    is_new = path == ':memory:' or not os.path.exists(path)
+    store = StatsStore(path)
+    if is_new and highscore_path is not None:
+        store.import_highscore(highscore_path)
+    return store
@@ -0,0 +1,225 @@
+"""
+Lockstep simulator that plays many independent AI games at once.
+
+All boards live in one boolean array of shape (games, rows, cols). Every step
+places one piece in each game that is still running: candidate placements of
+all games are enumerated, scored against each game's weights and applied with
+array operations. Scores, levels and the 7-bag piece order follow Tetris.main,
+so a game started from seed s scores the same as Tetris.main(seed=s) with a
+TetrisAgent holding the same weights.
+"""
+import random
+import time
+import numpy as np
+from agent import board_features
+from board import Board
+from rules import PieceBag, shapes, shape_table, col, row, line_clear_score
+
+# points per number of lines cleared at once, at level 1
+SCORE_MULTIPLIERS = np.array([line_clear_score(lines, 1) for lines in range(5)])
+NO_BUDGET = np.iinfo(np.int64).max
+
+
+class ShapeCandidates:
+    """Every (rotation, x) placement of one shape, in the order TetrisAgent tries them."""
+    def __init__(self, orientations, cols):
+        rotations, xs, columns, bottoms, cells_x, cells_y, min_y = [], [], [], [], [], [], []
+        for rotation, orientation in enumerate(orientations):
+            for x in range(-orientation.min_x, cols - orientation.max_x):
+                rotations.append(rotation)
+                xs.append(x)
+                # pad to 4 columns by repeating the first one, which doesn't change the minimum
+                bottom = orientation.bottom + [orientation.bottom[0]] * (4 - len(orientation.bottom))
+                columns.append([x + dx for dx, dy in bottom])
+                bottoms.append([dy for dx, dy in bottom])
+                cells_x.append([x + dx for dx, dy in orientation.cells])
+                cells_y.append([dy for dx, dy in orientation.cells])
+                min_y.append(orientation.min_y)
+
+        self.rotations = np.array(rotations)
+        self.xs = np.array(xs)
+        self.columns = np.array(columns)
+        self.bottoms = np.array(bottoms)
+        self.cells_x = np.array(cells_x)
+        self.cells_y = np.array(cells_y)
+        self.min_y = np.array(min_y)
+
+
+def state_layout(num_games, rows=row, cols=col):
+    """(name, dtype, shape) of every array the state of a batch of games is kept in."""
+    return [
+        ('boards', np.bool_, (num_games, rows, cols)),
+        ('scores', np.int64, (num_games,)),
+        ('lines', np.int64, (num_games,)),
+        ('levels', np.int64, (num_games,)),
+        ('pieces_placed', np.int64, (num_games,)),
+        ('alive', np.bool_, (num_games,)),
+    ]
+
+
+class VectorTetris:
+    def __init__(self, weights, seeds, cols=col, rows=row, timer=None, max_pieces=None, state=None):
+        """
+        Args:
+            weights: Array of shape (games, 4) with the agent weights of every game.
+            seeds: One piece sequence seed per game.
+            timer: PhaseTimer that times the placement and line clear of every step.
+            max_pieces: Piece budget of every game, one for all or one per game, None for no budget.
+            state: Arrays to keep the boards, scores, lines, levels, pieces placed and running games in,
+                by the names and shapes of state_layout, e.g. views of shared memory. New ones by default.
+        """
+        self.weights = np.asarray(weights, dtype=float)
+        self.seeds = list(seeds)
+        self.num_games = len(self.seeds)
+        if max_pieces is None:
+            max_pieces = NO_BUDGET
+        self.max_pieces = np.broadcast_to(np.asarray(max_pieces, dtype=np.int64), (self.num_games,))
+        self.cols = cols
+        self.rows = rows
+        self.timer = timer
+        self.candidates = [ShapeCandidates(orientations, cols) for orientations in shape_table]
+        self.state = state
+        self.reset()
+
+    def reset(self):
+        n = self.num_games
+        state = self.state
+        if state is None:
+            state = {name: np.empty(shape, dtype) for name, dtype, shape in state_layout(n, self.rows, self.cols)}
+        # the arrays are filled in place, so a caller holding them sees every step
+        self.boards = state['boards']
+        self.boards[...] = False
+        self.scores = state['scores']
+        self.scores[...] = 0
+        self.lines = state['lines']
+        self.lines[...] = 0
+        self.levels = state['levels']
+        self.levels[...] = 1
+        self.pieces_placed = state['pieces_placed']
+        self.pieces_placed[...] = 0
+        self.alive = state['alive']
+        self.alive[...] = True
+
+        self.bags = [PieceBag(random.Random(seed)) for seed in self.seeds]
+        self.current = np.array([self.next_shape(i) for i in range(n)])
+        self.next = np.array([self.next_shape(i) for i in range(n)])
+
+    def next_shape(self, game):
+        """Draws the next shape index of a game from its piece bag."""
+        return self.bags[game].get_shape().index
+
+    def column_tops(self, boards):
+        """Row of the highest filled cell of every column, or the number of rows for empty columns."""
+        return np.where(boards.any(axis=1), boards.argmax(axis=1), self.rows)
+
+    def step(self):
+        """Places one piece in every running game."""
+        games = np.flatnonzero(self.alive)
+        if not len(games):
+            return
+
+        timer = self.timer
+        if timer is not None:
+            start = timer.start()
+        for shape in range(len(shapes)):
+            shape_games = games[self.current[games] == shape]
+            if len(shape_games):
+                self.place_shape(shape, shape_games)
+        if timer is not None:
+            timer.add('decision', start)
+            start = timer.start()
+
+        self.clear_rows(games)
+        self.pieces_placed[games] += 1
+        if timer is not None:
+            timer.add('lock_clear', start)
+            timer.count('pieces', len(games))
+
+        for i in games:
+            self.current[i] = self.next[i]
+            self.next[i] = self.next_shape(i)
+
+        self.alive[games] = ~self.boards[games, 0, :].any(axis=1) & (self.pieces_placed[games] < self.max_pieces[games])
+
+    def place_shape(self, shape, games):
+        """Chooses and locks the best placement of the same shape in several games."""
+        cand = self.candidates[shape]
+        n, k = len(games), len(cand.xs)
+        boards = self.boards[games]
+        tops = self.column_tops(boards)
+
+        # landing row of every candidate in every game, from the column tops and the bottom profile
+        landing = (tops[:, cand.columns] - 1 - cand.bottoms).min(axis=2)
+        valid = landing + cand.min_y >= 0
+
+        # boards after every candidate placement, clipped above the top so invalid ones stay in range
+        cell_y = np.clip(landing[:, :, None] + cand.cells_y, 0, self.rows - 1)
+        cell_x = np.broadcast_to(cand.cells_x, cell_y.shape)
+        game_idx = np.broadcast_to(np.arange(n)[:, None, None], cell_y.shape)
+        cand_idx = np.broadcast_to(np.arange(k)[None, :, None], cell_y.shape)
+        resulting = np.repeat(boards[:, None], k, axis=1)
+        resulting[game_idx, cand_idx, cell_y, cell_x] = True
+
+        features = board_features(resulting.reshape(n * k, self.rows, self.cols)).reshape(n, k, 4)
+        lines_cleared, holes, aggregate_height, bumpiness = np.moveaxis(features, 2, 0)
+        w = self.weights[games]
+        scores = (w[:, 0:1] * lines_cleared -
+                  w[:, 1:2] * holes -
+                  w[:, 2:3] * aggregate_height -
+                  w[:, 3:4] * bumpiness)
+        scores[~valid] = -np.inf
+
+        best = scores.argmax(axis=1)
+        has_move = valid.any(axis=1)
+        chosen = np.flatnonzero(has_move)
+        self.boards[games[chosen]] = resulting[chosen, best[chosen]]
+
+        for i in np.flatnonzero(~has_move):
+            self.place_default(shape, games[i])
+
+    def place_default(self, shape, game):
+        """Hard drops the spawn rotation at the spawn column, the move TetrisAgent falls back to."""
+        board = Board(self.cols, self.rows)
+        for y in range(self.rows):
+            board.rows[y] = int(np.dot(self.boards[game, y], 1 << np.arange(self.cols)))
+        masks = shape_table[shape][0].masks
+        top = board.drop(masks, 5 - 2, -4)
+        board.place(masks, 5 - 2, top)
+        for y in range(self.rows):
+            self.boards[game, y] = board.rows[y] >> np.arange(self.cols) & 1 == 1
+
+    def clear_rows(self, games):
+        """Clears full rows and updates lines, score and level of the given games."""
+        boards = self.boards[games]
+        full = boards.all(axis=2)
+        cleared = full.sum(axis=1)
+        if not cleared.any():
+            return
+
+        # move full rows to the top keeping the order of the others, then empty them
+        order = np.argsort(~full, axis=1, kind='stable')
+        boards = np.take_along_axis(boards, order[:, :, None], axis=1)
+        boards[np.arange(self.rows)[None, :] < cleared[:, None]] = False
+        self.boards[games] = boards
+
+        levels = self.levels[games]
+        self.scores[games] += SCORE_MULTIPLIERS[cleared] * levels
+        self.lines[games] += cleared
+        self.levels[games] = levels + ((cleared > 0) & (self.lines[games] >= levels * 10))
+
+    def run(self, time_limit=None):
+        """
+        Plays every game until it is lost or has used up its piece budget, or until time_limit
+        seconds have passed. Returns the scores.
+        """
+        deadline = time.perf_counter() + time_limit if time_limit is not None else None
+        while self.alive.any():
+            self.step()
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        return self.scores
+
+
+def run_batch(weights, seeds, timer=None, max_pieces=None, time_limit=None):
+    """Plays one game per (weights, seed) pair in lockstep and returns the scores."""
+    return VectorTetris(weights, seeds, timer=timer, max_pieces=max_pieces).run(time_limit)